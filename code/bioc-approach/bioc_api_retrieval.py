@@ -9,17 +9,38 @@ import re
 import glob
 import logging
 import os
+import io
+import gzip
 from shutil import rmtree
-from tqdm.notebook import tqdm, trange
+from tqdm.notebook import tqdm
 from multiprocessing import Pool, freeze_support
 from datetime import date
 
-def requestAPI(pmid_chunk, filename):
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pmid-store'))
+from sharded_store import ShardedStore
+from pmid_registry import PMIDRegistry, RETRIEVAL, RETRIEVED, NO_API_ENTRY, REQUEST_FAILED, missing_reasons
+
+# Base URL of the BioC API, can be pointed to a local stand-in server.
+BIOC_URL = os.environ.get('BIOC_API_URL', 'https://www.ncbi.nlm.nih.gov/research/bionlp/RESTful/pubmed.cgi')
+
+def buildURL(pmid_chunk, base_url=BIOC_URL):
+    '''
+    Function to build the BioC API request URL of a list of pmids.
+    '''
+    pmid_string = ''
+    for id in pmid_chunk:
+        string = f'{id}|'
+        pmid_string += string
+    return f"{base_url}/BioC_xml/{pmid_string}/unicode"
+
+def requestAPI(pmid_chunk, filename, base_url=BIOC_URL, raw=False):
     '''
     Function to request XML data from ncbi RESTful API and safe it to './data/xml-files/chunk-xml'.
     
     Input:  pmid_chunk ->  List of pmids that get requested per request (maximum 400).
-            filename -> The filename of the output xml.
+            filename -> The filename of the output xml, gzip compressed if it ends with '.gz' (raw mode only).
+            base_url -> Base URL of the BioC API.
+            raw -> Store the response bytes as received instead of the prettified xml, read them with processPMID(compact=True).
     Output: xml-file named './data/{project}/xml-files/{pmid}.xml'
     '''
     if not isinstance(pmid_chunk, list):
@@ -31,27 +52,37 @@ def requestAPI(pmid_chunk, filename):
     elif not isinstance(filename, str):
         logging.error("Wrong parameter type for requestAPI, filename.")
         sys.exit("filepath needs to be of type String")
-    pmid_string = ''
-    for id in pmid_chunk:
-        string = f'{id}|'
-        pmid_string += string
     try:
-        url = f"https://www.ncbi.nlm.nih.gov/research/bionlp/RESTful/pubmed.cgi/BioC_xml/{pmid_string}/unicode"
+        url = buildURL(pmid_chunk, base_url)
         resp = requests.get(url)
-        xml_data = BeautifulSoup(resp.content, 'xml')
-        with open(filename, 'w') as f:
-            f.write(xml_data.prettify())
+        resp.raise_for_status()
+        if raw:
+            with (gzip.open if filename.endswith('.gz') else open)(filename, 'wb') as f:
+                f.write(resp.content)
+        else:
+            xml_data = BeautifulSoup(resp.content, 'xml')
+            with open(filename, 'w') as f:
+                f.write(xml_data.prettify())
         logging.info(f'Finished and saved to: {filename}')
     except Exception:
         logging.error("API Request couldn't be made.", exc_info=True)
 
-def chunk_requestAPI(pmidList, outputFolder, chunk_size=400, processes=30, **kwargs):
+def chunkSuffix(compress=False):
+    '''
+    Function returning the file extension of chunk files.
+    '''
+    return '.xml.gz' if compress else '.xml'
+
+def chunk_requestAPI(pmidList, outputFolder, chunk_size=400, processes=30, raw=False, compress=False, **kwargs):
     '''
     Function to chunk the pmidList and run requestAPI in parallel.
     Input:  pmidList -> List of pmids to be retrieved.
             outputFolder -> Directory with the output formatted xml files.
             chunk_size -> Number of pmids per request.
             processes -> Number of parallel processes.
+            raw -> Store the responses as received (see requestAPI).
+            compress -> Gzip the raw responses to chunk-{i}.xml.gz.
+    Output: List of the pmids of all chunks without response file.
     '''
     if not isinstance(chunk_size, int):
         logging.error("Wrong parameter type for chunk_requestAPI, chunk_size.")
@@ -67,22 +98,29 @@ def chunk_requestAPI(pmidList, outputFolder, chunk_size=400, processes=30, **kwa
         sys.exit("filepath needs to be of type String")
     
     pmidList_chunked = [pmidList[i:i + chunk_size] for i in range(0, len(pmidList), chunk_size)] 
-    output_filenames = [f'{outputFolder}/chunk-{pmidList_chunked.index(pmid_chunk)}.xml' for pmid_chunk in pmidList_chunked]
-    arguments = list(zip(pmidList_chunked, output_filenames)) 
+    output_filenames = [f'{outputFolder}/chunk-{i}{chunkSuffix(raw and compress)}' for i in range(len(pmidList_chunked))]
+    arguments = [(pmid_chunk, filename, kwargs.get('base_url', BIOC_URL), raw) for pmid_chunk, filename in zip(pmidList_chunked, output_filenames)]
+    # Chunk files of an earlier run would be taken for responses of this one.
+    for filename in output_filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
     try:
         freeze_support()
         with Pool(processes) as p:
             p.starmap(requestAPI, arguments)
     except Exception:
         logging.error("Multiple API request couldn't be made.", exc_info=True)
+    return [pmid for pmid_chunk, filename in zip(pmidList_chunked, output_filenames)
+            if not os.path.exists(filename) for pmid in pmid_chunk]
 
-def createXML(document, filename):
+def createXML(document, filename, store=None):
     '''
     Function to create an xml file from a document object. 
     Iterates through all elements in the document object and passes xml tags, attributes, text and tails.
     
-    Input:  filename -> String: The filename of the output xml.
+    Input:  filename -> String: The filename of the output xml, or the pmid if a store is given.
             document -> xml Element Object: Containing the content of the resulting xml
+            store -> ShardedStore: Optional store the xml is appended to instead of writing a file.
     Output: written xml-file based on the filename defined.
     '''
     if not isinstance(filename, str):
@@ -90,31 +128,145 @@ def createXML(document, filename):
         sys.exit("filename needs to be of type String")
     else:
         try:
-            new_root = Element('collection', {})
-            new_root.text = '\n '
-            tree = ElementTree(new_root)
-            var = SubElement(new_root, document.tag, attrib=document.attrib)
-            var.text = document.text
-            var.tail = document.tail
-            for element in document:
-                var_1 = SubElement(var, element.tag, attrib=element.attrib)
-                var_1.text = element.text
-                var_1.tail = element.tail
-                for subelement in element:
-                    var_2 = SubElement(var_1, subelement.tag, attrib=subelement.attrib)
-                    var_2.text = subelement.text
-                    var_2.tail = subelement.tail
-            with open(filename, 'wb') as f:
-                tree.write(f, encoding='utf-8', xml_declaration=True)
+            if store is not None:
+                store.put(filename, documentXML(document))
+            else:
+                with open(filename, 'wb') as f:
+                    f.write(documentXML(document))
         except Exception:
             logging.error("Error in createXML.", exc_info=True)
 
-def processPMID(inputPath, outputPath):
+def documentXML(document):
+    '''
+    Function to serialize a document object into the content of its xml file (see createXML).
+    '''
+    new_root = Element('collection', {})
+    new_root.text = '\n '
+    tree = ElementTree(new_root)
+    var = SubElement(new_root, document.tag, attrib=document.attrib)
+    var.text = document.text
+    var.tail = document.tail
+    for element in document:
+        var_1 = SubElement(var, element.tag, attrib=element.attrib)
+        var_1.text = element.text
+        var_1.tail = element.tail
+        for subelement in element:
+            var_2 = SubElement(var_1, subelement.tag, attrib=subelement.attrib)
+            var_2.text = subelement.text
+            var_2.tail = subelement.tail
+    output = io.BytesIO()
+    tree.write(output, encoding='utf-8', xml_declaration=True)
+    return output.getvalue()
+
+def parseDocument(document, compact=False):
+    '''
+    Function to retrieve [PMID, Title and Abstract] from a single document object.
+
+    Input:  document -> xml Element Object of a <document>.
+            compact -> The values are stored as received and need no whitespace removal.
+    Output: (pmid, title, abstract, complete), complete is False if the document does not have
+            exactly two <passage> and two <text> tags. Title and abstract are None if not found.
+    '''
+    pmid = None
+    for id in document.findall('id'):
+        pmid = id.text if compact else re.sub(r"\n+", "", id.text).strip(' ')
+    passages = 0
+    texts = 0
+    for element in document.iter():
+        if element.tag == 'passage':
+            passages += 1
+        elif element.tag == 'text':
+            texts += 1
+    if passages != 2 or texts != 2:
+        return pmid, None, None, False
+    title = None
+    abstract = None
+    for passage in document.findall('passage'):
+        if compact:
+            infon = passage.find('infon').text
+            text = passage.find('text').text or ''
+        else:
+            infon = re.sub(r"\n+\s+", "", passage.find('infon').text)
+            text = re.sub(r"\n+", "", passage.find('text').text).strip(' ')
+        if infon == 'title':
+            title = str(text)
+        if infon == 'abstract':
+            abstract = str(text)
+    return pmid, title, abstract, True
+
+def iterDocuments(xml_file):
+    '''
+    Function to iterate over the <document> elements of a (gzipped) chunk file with incremental parsing.
+    A document is yielded once its tail has been parsed and cleared afterwards, so only one document is kept in memory.
+    '''
+    with (gzip.open if xml_file.endswith('.gz') else open)(xml_file, 'rb') as f:
+        depth = 0
+        root = None
+        pending = None
+        for event, element in et.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = element
+                elif depth == 2 and pending is not None:
+                    yield pending
+                    pending = None
+                    root.clear()
+            else:
+                depth -= 1
+                if depth == 1 and element.tag == 'document':
+                    pending = element
+                elif depth == 0 and pending is not None:
+                    yield pending
+
+def processChunk(task):
+    '''
+    Function to process a single chunk file, runs in the worker processes of processPMID.
+
+    Input:  task -> (xml_file, outputPath, compact, keep_documents)
+    Output: (pmids, titles, abstracts, skipped_pmids, documents), documents holds the (pmid, xml) of all
+            complete documents if keep_documents is set, otherwise their xml files are written to outputPath.
+    '''
+    xml_file, outputPath, compact, keep_documents = task
+    pmids = []
+    titles = []
+    abstracts = []
+    skipped_pmids = []
+    documents = []
+    try:
+        for document in iterDocuments(xml_file):
+            pmid, title, abstract, complete = parseDocument(document, compact)
+            if not complete:
+                skipped_pmids.append(pmid)
+                continue
+            pmids.append(pmid)
+            titles.append(title)
+            abstracts.append(abstract)
+            if keep_documents:
+                documents.append((pmid, documentXML(document)))
+            else:
+                outputFilename = f'{outputPath}/{pmid}.xml'
+                if not os.path.exists(outputFilename):
+                    try:
+                        createXML(document, outputFilename)
+                    except Exception:
+                        logging.error("OutputPath is not valid.", exc_info=True)
+    except Exception as error:
+        raise RuntimeError(f'Error while processing {xml_file}: {error}') from error
+    return pmids, titles, abstracts, skipped_pmids, documents
+
+def processPMID(inputPath, outputPath, store=None, compact=False, processes=1):
     '''
     Function to retrieve [PMID, Title and Abstract] from chunked XML-files.
+    The chunk files are parsed incrementally, in parallel if processes > 1, into columns
+    from which the resulting DataFrame is built once.
     
     Input:  inputPath -> Directory with the chunked xml files.
             outputPath -> Directory with the output formatted xml files.
+            store -> ShardedStore: Optional store the formatted xml files are appended to instead of outputPath.
+            compact -> The chunk files hold the responses as received (raw or asynchronous retrieval, optionally gzipped),
+                       their values are read directly without removing the whitespace added by prettify.
+            processes -> Number of worker processes parsing chunk files.
     Output: Returns pandas.DataFrame(columns=['PMID', 'title', 'abstract']) for retrieved pmids
             and pandas.DataFrame(columns=['PMID', 'reason']) for missing pmids
     '''
@@ -125,71 +277,104 @@ def processPMID(inputPath, outputPath):
         logging.error("Wrong parameter type for processPMID, outputPath.")
         sys.exit("outputPath needs to be of type String")
     else:
-        pubmedData_df = pd.DataFrame(columns=['PMID', 'title', 'abstract'], dtype=object)
-        skipped_pmids = []
+        xml_files = []
         try:
             xml_files = glob.glob(inputPath+'/*.xml', recursive=True)
+            if compact:
+                xml_files += glob.glob(inputPath+'/*.xml.gz', recursive=True)
         except Exception:
             logging.error("InputPath is not valid.", exc_info=True)
-        pubmedData_df = pd.DataFrame(columns=['PMID', 'title', 'abstract'], dtype=object)
-        doc_dicts = []
+        xml_files.sort()
         logging.info(f'Processing {len(xml_files)} chunk files.')
-        for i in trange(len(xml_files)): # iterate through all chunk-{i}.xml files
-            xml_file = xml_files[i]
-            root = et.parse(xml_file).getroot() 
-            for document in root.findall('document'):
-                element_lst = [element.tag for element in document.iter()]
-                document_dict = {}
-                for id in document.findall('id'):
-                    pmid = re.sub(r"\n+", "", id.text)
-                    pmid = pmid.strip(' ')
-                if element_lst.count('passage') == 2:
-                    if element_lst.count('text') == 2: 
-                        document_dict['PMID'] = pmid
-                        outputFilename = f'{outputPath}/{pmid}.xml'
-                        if not os.path.exists(outputFilename):
-                            try:
-                                createXML(document, outputFilename)
-                            except Exception:
-                                logging.error("OutputPath is not valid.", exc_info=True)
-                        else:
-                            #logging.info('File already exists.')
-                            pass
-                        for passage in document.findall('passage'):
-                            infon = re.sub(r"\n+\s+", "", passage.find('infon').text)
-                            if infon == 'title':
-                                title = passage.find('text').text
-                                title = re.sub(r"\n+", "", title)
-                                title = title.strip(' ')
-                                document_dict['title'] = str(title)
-                            if infon == 'abstract':
-                                abstract = passage.find('text').text
-                                abstract = re.sub(r"\n+", "", abstract)
-                                abstract = abstract.strip(' ')
-                                document_dict['abstract'] = str(abstract)
-                        doc_dicts.append(document_dict)
-                        doc_df = pd.DataFrame(doc_dicts)
-                    else:
-                        skipped_pmids.append(pmid)
-                        #logging.info(f'Only one <text> tag found. Either title or abstract is missing. Skipping PMID {pmid}...')
-                        continue
-                else:
-                    skipped_pmids.append(pmid)
-                    #logging.info(f'Only one <passage> tag found. Either title or abstract is missing. Skipping PMID {pmid}...')
-                    continue
+        tasks = [(xml_file, outputPath, compact, store is not None) for xml_file in xml_files]
+        columns = {'PMID': [], 'title': [], 'abstract': []}
+        skipped_pmids = []
+        pool = Pool(processes) if processes > 1 else None
         try:
-            pubmedData_df = pd.concat([pubmedData_df, doc_df], axis=0, ignore_index=True)
-        except:
-            skipped_pmids.append(pmid)
-            logging.error('Error while processing PMIDs.')
+            results = pool.imap(processChunk, tasks) if pool is not None else map(processChunk, tasks)
+            for pmids, titles, abstracts, skipped, documents in tqdm(results, total=len(tasks)):
+                columns['PMID'] += pmids
+                columns['title'] += titles
+                columns['abstract'] += abstracts
+                skipped_pmids += skipped
+                for pmid, document in documents:
+                    if pmid not in store:
+                        store.put(pmid, document)
+        except Exception:
+            # Returning the pmids parsed so far would report all others as missing.
+            logging.error('Error while processing PMIDs.', exc_info=True)
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        pubmedData_df = pd.DataFrame(columns, dtype=object)
         return pubmedData_df, skipped_pmids
 
-def main(pmidList, parentPath, log=False, delete_tmp=False, **kwargs):
+def requestChunks(pmidList, chunkPath, asynchronous=False, **kwargs):
+    '''
+    Function to request the chunks of pmidList with either the process pool or the asyncio engine.
+    Output: List of the pmids of the chunks that could not be retrieved.
+    '''
+    if asynchronous:
+        from bioc_async_retrieval import async_chunk_requestAPI
+        stats = async_chunk_requestAPI(pmidList, chunkPath, **kwargs)
+        return [pmid for chunk in stats['failed'] for pmid in chunk['pmids']]
+    return chunk_requestAPI(pmidList, chunkPath, **kwargs)
+
+def requestCached(pmidList, parentPath, cache, ttl=None, asynchronous=False, **kwargs):
+    '''
+    Function to request only the pmids missing in the retrieval cache into '{parentPath}/temp/chunk-fetch',
+    add the responses to the cache and write the chunk files of the whole pmidList to '{parentPath}/temp/chunk-xml'.
+    
+    Input:  pmidList -> List of pmids to be retrieved.
+            parentPath -> Parent directory of the temp directory.
+            cache -> Filepath of the retrieval cache.
+            ttl -> Seconds after which cached documents expire, None to keep them forever.
+    Output: List of the pmids of the chunks that could not be retrieved or added to the cache.
+    '''
+    from retrieval_cache import RetrievalCache
+    chunk_size = kwargs.get('chunk_size', 400)
+    suffix = chunkSuffix(kwargs.get('compress', False) and (asynchronous or kwargs.get('raw', False)))
+    fetchPath = f'{parentPath}/temp/chunk-fetch'
+    chunkPath = f'{parentPath}/temp/chunk-xml'
+    with RetrievalCache(cache, ttl=ttl) as retrievalCache:
+        pending = retrievalCache.missing(pmidList)
+        logging.info(f'{len(pmidList) - len(pending)} PMIDs cached, requesting {len(pending)} PMIDs.')
+        for path in (fetchPath, chunkPath):
+            rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+        if pending:
+            requestChunks(pending, fetchPath, asynchronous, **kwargs)
+        failed, failed_chunks = [], 0
+        for i in range(0, len(pending), chunk_size):
+            if not retrievalCache.ingestChunk(f'{fetchPath}/chunk-{i // chunk_size}{suffix}', pending[i:i + chunk_size]):
+                failed += pending[i:i + chunk_size]
+                failed_chunks += 1
+        if failed_chunks:
+            logging.error(f'{failed_chunks} chunks could not be retrieved, their PMIDs are requested again by the next run.')
+        retrievalCache.exportChunks(pmidList, chunkPath, chunk_size)
+    return failed
+
+def main(pmidList, parentPath, log=False, delete_tmp=False, store=False, asynchronous=False, cache=None, ttl=None, parse_processes=1, registry=None, **kwargs):
     '''
     Main function that runs processPMID on the retrieved xml files and compares it to the pmidList input.
     Input:  pmidList -> List of pmids to be retrieved.
             inputPath -> Directory with the chunked xml files.
             outputPath -> Directory with the output formatted xml files.
+            store -> Write the formatted xml files to the sharded store '{parentPath}/temp/pmid-store' (see code/pmid-store)
+                     instead of one file per pmid in '{parentPath}/temp/pmid-xml'.
+            asynchronous -> Retrieve the chunks with the asyncio engine of bioc_async_retrieval.py, which takes the
+                            keyword arguments base_url, rate, concurrency, retries, backoff and timeout.
+            raw, compress -> Store the responses as received, optionally gzipped, and parse them with the compact parser
+                             of processPMID. Responses of the asyncio engine are always stored as received.
+            cache -> Filepath of a persistent retrieval cache (see retrieval_cache.py). Only pmids which are not cached
+                     or whose entry has expired are requested, the chunk files are then written from the cache
+                     in compact form.
+            ttl -> Seconds after which cached documents expire, None to keep them forever.
+            parse_processes -> Number of worker processes of processPMID.
+            registry -> Filepath of a PMID registry (see code/pmid-store/pmid_registry.py) the retrieval status
+                        of every pmid is recorded in.
     '''
     if log:
         logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -201,32 +386,38 @@ def main(pmidList, parentPath, log=False, delete_tmp=False, **kwargs):
         pmidPath = f'{parentPath}/temp/pmid-xml'
         os.makedirs(chunkPath, exist_ok=True)
         os.makedirs(pmidPath, exist_ok=True)
-        chunk_requestAPI(pmidList, chunkPath, **kwargs)
+        if cache:
+            failed_pmids = requestCached(pmidList, parentPath, cache, ttl, asynchronous, **kwargs)
+        else:
+            failed_pmids = requestChunks(pmidList, chunkPath, asynchronous, **kwargs)
 
         # Initiate processPMID function to retrieve abstracts and titles
-        pubmedData_df, skipped_pmids = processPMID(chunkPath, pmidPath)
+        # Cached documents are always exported in compact form (see retrieval_cache.py).
+        compact = bool(cache) or asynchronous or kwargs.get('raw', False)
+        if store:
+            with ShardedStore(f'{parentPath}/temp/pmid-store') as pmidStore:
+                pubmedData_df, skipped_pmids = processPMID(chunkPath, pmidPath, pmidStore, compact, parse_processes)
+        else:
+            pubmedData_df, skipped_pmids = processPMID(chunkPath, pmidPath, compact=compact, processes=parse_processes)
         pubmedData_df.sort_values('PMID').to_csv(f'{parentPath}/documents_{today}.tsv', sep='\t', index=False, quotechar="`")
         logging.info(f'Titles, abstracts and pmids saved to tsv file (Path: {parentPath}/documents_{today}.tsv).')
         
         # Check missing pmids
-        missing_pmids = [str(pmid) for pmid in pmidList if str(pmid) not in pubmedData_df['PMID'].to_list()]
-        if len(missing_pmids) > 0:
-            logging.info(f'Missing PMIDs: {len(missing_pmids)}')
+        missing_pmids_df = missing_reasons(pmidList, pubmedData_df['PMID'], skipped_pmids, failed_pmids)
+        if len(missing_pmids_df) > 0:
+            logging.info(f'Missing PMIDs: {len(missing_pmids_df)}')
             logging.info(f'Missing due to no title or abstract: {len(skipped_pmids)}')
-            logging.info(f'Probably missing due to non-existing API entry: {len([str(pmid) for pmid in missing_pmids if str(pmid) not in skipped_pmids])}')
-            missing_pmids_df = pd.DataFrame({'PMID':missing_pmids, 'Reason': ''})
-            no_api_entry = [str(pmid) for pmid in missing_pmids if str(pmid) not in skipped_pmids]
-            for pmid in missing_pmids:
-                if pmid in skipped_pmids:
-                    missing_pmids_df.loc[missing_pmids_df.PMID == pmid, 'Reason'] = 'No title or abstract'
-                elif pmid in no_api_entry:
-                    missing_pmids_df.loc[missing_pmids_df.PMID == pmid, 'Reason'] = 'No API entry'
-                else:
-                    missing_pmids_df.loc[missing_pmids_df.PMID == pmid, 'Reason'] = 'Unknown'
+            logging.info(f"Missing due to failed requests: {(missing_pmids_df['Reason'] == REQUEST_FAILED).sum()}")
+            logging.info(f"Probably missing due to non-existing API entry: {(missing_pmids_df['Reason'] == NO_API_ENTRY).sum()}")
             missing_pmids_df.to_csv(f'{parentPath}/missing_{today}.tsv', sep='\t', index=False, quotechar="`")
             logging.info(f'Missing pmids saved to tsv file (Path: {parentPath}/missing_{today}.tsv).')
         else:
             logging.info('All titles and abstracts successfully retrieved.')
+        if registry:
+            with PMIDRegistry(registry) as pmidRegistry:
+                pmidRegistry.update(RETRIEVAL, pubmedData_df['PMID'], RETRIEVED)
+                pmidRegistry.update(RETRIEVAL, missing_pmids_df['PMID'], missing_pmids_df['Reason'])
+            logging.info(f'Retrieval status recorded in the registry (Path: {registry}).')
         if delete_tmp:
             rmtree(f'{parentPath}/temp')
         logging.info('Finished script.')
@@ -0,0 +1,184 @@
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import asyncio
+import logging
+
+import aiohttp
+
+from bioc_api_retrieval import BIOC_URL, buildURL, chunkSuffix
+
+'''
+Asyncio retrieval engine for the BioC API. All chunks are requested through a single
+pooled aiohttp session by a fixed number of worker tasks, a token bucket keeps the
+requests within a global requests-per-second budget, and requests failing with 429, 5xx,
+timeouts or connection errors are retried with exponential backoff. Responses are streamed
+to disk as received, chunks that still fail are reported instead of being dropped.
+'''
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class RetryableError(Exception):
+    '''
+    Raised for responses that should be retried, optionally carrying the Retry-After delay.
+    '''
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    '''
+    Global rate limit shared by all workers.
+
+    Input:  rate -> Requests per second.
+            burst -> Maximum number of requests sent at once after an idle period.
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def retryAfter(resp):
+    '''
+    Returns the Retry-After header of a response in seconds, None if missing or not a number.
+    '''
+    try:
+        return float(resp.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+async def fetchChunk(session, bucket, pmid_chunk, filename, stats, base_url=BIOC_URL, retries=5, backoff=1.0):
+    '''
+    Requests one chunk and streams the response to filename, retrying on 429, 5xx, timeouts and connection errors.
+
+    Input:  session -> aiohttp.ClientSession: The shared session.
+            bucket -> TokenBucket: The global rate limit.
+            pmid_chunk -> List of pmids of the chunk.
+            filename -> The filename of the output xml, gzip compressed if it ends with '.gz'.
+            stats -> dict: Counters and latencies updated by every request.
+    Output: None on success, otherwise the error of the last attempt.
+    '''
+    url = buildURL(pmid_chunk, base_url)
+    for attempt in range(retries + 1):
+        await bucket.acquire()
+        start = time.monotonic()
+        stats['requests'] += 1
+        try:
+            async with session.get(url) as resp:
+                if resp.status in RETRY_STATUS:
+                    raise RetryableError(f'HTTP {resp.status}', retryAfter(resp))
+                if resp.status != 200:
+                    stats['latencies'].append(time.monotonic() - start)
+                    return f'HTTP {resp.status}'
+                with (gzip.open if filename.endswith('.gz') else open)(f'{filename}.part', 'wb') as f:
+                    async for block in resp.content.iter_chunked(1 << 16):
+                        f.write(block)
+            os.replace(f'{filename}.part', filename)
+            stats['latencies'].append(time.monotonic() - start)
+            return None
+        except (RetryableError, asyncio.TimeoutError, aiohttp.ClientError) as error:
+            stats['latencies'].append(time.monotonic() - start)
+            message = str(error) or type(error).__name__
+            if attempt == retries:
+                return message
+            stats['retries'] += 1
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            if isinstance(error, RetryableError) and error.retry_after is not None:
+                delay = max(delay, error.retry_after)
+            logging.info(f'Retrying {filename} in {delay:.1f}s after: {message}')
+            await asyncio.sleep(delay)
+
+async def retrieveChunks(pmid_chunks, filenames, base_url=BIOC_URL, rate=3.0, concurrency=10, retries=5, backoff=1.0, timeout=120):
+    '''
+    Requests all chunks with a pool of worker tasks sharing one session and one rate limit.
+
+    Input:  pmid_chunks -> List of pmid lists.
+            filenames -> Output filename of every chunk.
+            base_url -> Base URL of the BioC API (i.e. a local stand-in server).
+            rate -> Maximum number of requests per second over all workers.
+            concurrency -> Number of requests in flight at the same time.
+            retries -> Number of retries per chunk.
+            backoff -> Base delay in seconds of the exponential backoff.
+            timeout -> Total timeout of a single request in seconds.
+    Output: dict with the number of 'requests' and 'retries', the 'latencies' of all requests,
+            the 'elapsed' time and the 'failed' chunks as list of {'chunk', 'pmids', 'error'}.
+    '''
+    stats = {'requests': 0, 'retries': 0, 'latencies': [], 'failed': []}
+    queue = asyncio.Queue()
+    for task in zip(pmid_chunks, filenames):
+        queue.put_nowait(task)
+    bucket = TokenBucket(rate, burst=max(1, min(concurrency, int(rate))))
+
+    async def worker(session):
+        while True:
+            try:
+                pmid_chunk, filename = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            error = await fetchChunk(session, bucket, pmid_chunk, filename, stats, base_url, retries, backoff)
+            if error is not None:
+                logging.error(f'Chunk {filename} failed: {error}')
+                stats['failed'].append({'chunk': filename, 'pmids': [str(pmid) for pmid in pmid_chunk], 'error': error})
+            else:
+                logging.info(f'Finished and saved to: {filename}')
+
+    start = time.monotonic()
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    stats['elapsed'] = time.monotonic() - start
+    return stats
+
+def async_chunk_requestAPI(pmidList, outputFolder, chunk_size=400, base_url=BIOC_URL, rate=3.0, concurrency=10,
+                           retries=5, backoff=1.0, timeout=120, compress=False, **kwargs):
+    '''
+    Function to chunk the pmidList and request all chunks with the asyncio engine,
+    drop-in replacement of chunk_requestAPI. Chunks which still fail after all retries
+    are listed in '{outputFolder}/failed_chunks.json'.
+
+    Input:  pmidList -> List of pmids to be retrieved.
+            outputFolder -> Directory of the chunk xml files.
+            chunk_size -> Number of pmids per request.
+            compress -> Gzip the responses to chunk-{i}.xml.gz.
+            Remaining parameters see retrieveChunks.
+    Output: The statistics of retrieveChunks.
+    '''
+    if not isinstance(chunk_size, int):
+        logging.error("Wrong parameter type for async_chunk_requestAPI, chunk_size.")
+        sys.exit("chunk_size needs to be of type Integer")
+    elif chunk_size > 400:
+        logging.error("Illegal parameter input for async_chunk_requestAPI, chunk_size.")
+        sys.exit("len(chunk_size) must not be higher than 400.")
+    elif not isinstance(outputFolder, str):
+        logging.error("Wrong parameter type for async_chunk_requestAPI, outputFolder.")
+        sys.exit("filepath needs to be of type String")
+
+    pmidList_chunked = [pmidList[i:i + chunk_size] for i in range(0, len(pmidList), chunk_size)]
+    output_filenames = [f'{outputFolder}/chunk-{i}{chunkSuffix(compress)}' for i in range(len(pmidList_chunked))]
+    stats = asyncio.run(retrieveChunks(pmidList_chunked, output_filenames, base_url, rate, concurrency, retries, backoff, timeout))
+
+    failed_filename = f'{outputFolder}/failed_chunks.json'
+    if stats['failed']:
+        with open(failed_filename, 'w') as f:
+            json.dump(stats['failed'], f, indent=1)
+        logging.error(f"{len(stats['failed'])} chunks failed, see {failed_filename}.")
+    elif os.path.exists(failed_filename):
+        os.remove(failed_filename)
+    logging.info(f"{len(pmidList_chunked)} chunks in {stats['elapsed']:.1f}s, {stats['requests']} requests, {stats['retries']} retries.")
+    return stats
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+
+from bioc_api_retrieval import chunk_requestAPI, chunkSuffix, iterDocuments
+from bioc_standin_server import StandInServer
+
+'''
+Load-test harness of the BioC retrieval engines. Both engines request the same pmids
+from a local stand-in server (see bioc_standin_server.py) for every combination of
+chunk size and concurrency, and every run reports:
+
+    rps           requests per second received by the server, retries included
+    docs_per_s    retrieved documents per second
+    retries       requests repeated by the client after 429, 5xx or timeouts
+    failed        chunks without response file after all retries
+    p50/p95/p99   request latency in seconds
+
+The asyncio engine reports its own client-side latencies. The process pool engine
+does not time its requests, so its latencies are the ones measured by the server.
+
+    python bioc_load_test.py -n 20000 --chunk_sizes 100 400 --concurrency 5 10 30 --latency 0.3 --rate_limit 20
+'''
+
+def countDocuments(outputFolder):
+    '''
+    Returns the number of documents and the number of chunk files in outputFolder.
+    '''
+    files = [os.path.join(outputFolder, name) for name in os.listdir(outputFolder)
+             if name.endswith('.xml') or name.endswith('.xml.gz')]
+    return sum(1 for xml_file in files for _ in iterDocuments(xml_file)), len(files)
+
+def runPool(pmidList, outputFolder, chunk_size, concurrency, base_url, compress=False, **kwargs):
+    '''
+    Runs chunk_requestAPI in raw mode with concurrency processes, which does not retry failed requests.
+    '''
+    start = time.monotonic()
+    chunk_requestAPI(pmidList, outputFolder, chunk_size, concurrency, raw=True, compress=compress, base_url=base_url)
+    return {'elapsed': time.monotonic() - start, 'retries': 0, 'latencies': None}
+
+def runAsync(pmidList, outputFolder, chunk_size, concurrency, base_url, compress=False, rate=1000.0, retries=5, backoff=0.1, timeout=120):
+    '''
+    Runs the asyncio engine of bioc_async_retrieval.py with concurrency requests in flight.
+    '''
+    from bioc_async_retrieval import retrieveChunks
+    pmid_chunks = [pmidList[i:i + chunk_size] for i in range(0, len(pmidList), chunk_size)]
+    filenames = [f'{outputFolder}/chunk-{i}{chunkSuffix(compress)}' for i in range(len(pmid_chunks))]
+    stats = asyncio.run(retrieveChunks(pmid_chunks, filenames, base_url, rate, concurrency, retries, backoff, timeout))
+    return {'elapsed': stats['elapsed'], 'retries': stats['retries'], 'latencies': stats['latencies']}
+
+ENGINES = {'pool': runPool, 'async': runAsync}
+
+def loadTest(pmidList, engines=('pool', 'async'), chunk_sizes=(400,), concurrencies=(10,), server=None, **kwargs):
+    '''
+    Runs every engine for every combination of chunk size and concurrency against the stand-in server.
+
+    Input:  pmidList -> List of pmids requested by every run.
+            engines -> Names of the engines, 'pool' (chunk_requestAPI) and/or 'async' (bioc_async_retrieval.py).
+            chunk_sizes -> Numbers of pmids per request.
+            concurrencies -> Numbers of processes (pool) or requests in flight (async).
+            server -> StandInServer: A running server, by default one without latency and errors is started.
+            kwargs -> Keyword arguments of the async engine (rate, retries, backoff, timeout).
+    Output: pandas.DataFrame with one row per run.
+    '''
+    own_server = server is None
+    if own_server:
+        server = StandInServer().start()
+    rows = []
+    try:
+        for engine in engines:
+            for chunk_size in chunk_sizes:
+                for concurrency in concurrencies:
+                    outputFolder = tempfile.mkdtemp(prefix='bioc-load-test-')
+                    try:
+                        server.reset()
+                        run = ENGINES[engine](pmidList, outputFolder, chunk_size, concurrency, server.url,
+                                              **(kwargs if engine == 'async' else {}))
+                        documents, files = countDocuments(outputFolder)
+                    finally:
+                        rmtree(outputFolder, ignore_errors=True)
+                    latencies = run['latencies'] if run['latencies'] is not None else server.stats['latencies']
+                    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (np.nan,) * 3
+                    rows.append({'engine': engine, 'chunk_size': chunk_size, 'concurrency': concurrency,
+                                 'elapsed': run['elapsed'], 'requests': server.stats['requests'],
+                                 'rps': server.stats['requests'] / run['elapsed'], 'documents': documents,
+                                 'docs_per_s': documents / run['elapsed'], 'retries': run['retries'],
+                                 'throttled': server.stats['throttled'], 'errors': server.stats['errors'],
+                                 'failed': -(-len(pmidList) // chunk_size) - files, 'p50': p50, 'p95': p95, 'p99': p99})
+                    logging.info(f'{engine}, chunk size {chunk_size}, concurrency {concurrency}: '
+                                 f'{rows[-1]["docs_per_s"]:.0f} documents/s, {rows[-1]["failed"]} failed chunks.')
+    finally:
+        if own_server:
+            server.stop()
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-n', '--pmids', type=int, default=10000,
+                        help='Number of pmids requested by every run')
+    parser.add_argument('--engines', type=str, nargs='+', default=['pool', 'async'], choices=list(ENGINES),
+                        help='Retrieval engines to test')
+    parser.add_argument('--chunk_sizes', type=int, nargs='+', default=[400],
+                        help='Numbers of pmids per request')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10],
+                        help='Numbers of processes (pool) or requests in flight (async)')
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help='Requests per second of the async engine')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='Retries per chunk of the async engine')
+    parser.add_argument('--backoff', type=float, default=0.1,
+                        help='Base delay of the async engine backoff in seconds')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Mean delay of a server response in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Server delays are drawn uniformly from latency +- jitter')
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help='Fraction of requests failing with 503')
+    parser.add_argument('--rate_limit', type=float, default=None,
+                        help='Requests per second accepted by the server before answering with 429')
+    parser.add_argument('--missing_rate', type=float, default=0.0,
+                        help='Fraction of pmids without API entry')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Path to an output TSV file of the results')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    pmidList = [str(pmid) for pmid in range(10000000, 10000000 + args.pmids)]
+    with StandInServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                       rate_limit=args.rate_limit, missing_rate=args.missing_rate) as server:
+        results = loadTest(pmidList, args.engines, args.chunk_sizes, args.concurrency, server,
+                           rate=args.rate, retries=args.retries, backoff=args.backoff)
+    print(results.to_string(index=False, float_format=lambda value: f'{value:.3f}'))
+    if args.output:
+        results.to_csv(args.output, sep='\t', index=False)
+    sys.exit(int(results['failed'].sum() > 0))
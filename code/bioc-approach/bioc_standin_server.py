@@ -0,0 +1,224 @@
+import re
+import sys
+import time
+import zlib
+import random
+import logging
+import argparse
+import threading
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+Local stand-in for the BioC API serving synthetic BioC XML for arbitrary pmid lists,
+so that the retrieval code can be measured and tested without requesting NCBI.
+Every request can be delayed, fail with a 5xx error or be throttled with 429, and
+pmids can be missing from the API or lack their abstract:
+
+    python bioc_standin_server.py --port 8765 --latency 0.2 --error_rate 0.05 --rate_limit 10
+
+    BIOC_API_URL=http://localhost:8765 python ...
+
+Missing and incomplete documents are chosen by a hash of the pmid, so every run
+returns the same documents for the same pmids.
+'''
+
+URL_PATTERN = re.compile(r'^/BioC_xml/([^/]*)/unicode/?$')
+WORDS = ('protein', 'expression', 'patients', 'cells', 'analysis', 'clinical', 'gene', 'treatment',
+         'results', 'study', 'disease', 'increased', 'significant', 'cancer', 'response', 'model')
+
+def pmidFraction(pmid, salt):
+    '''
+    Returns a fixed number in [0, 1) for a pmid, used to decide whether it is missing or incomplete.
+    '''
+    return zlib.crc32(f'{salt}:{pmid}'.encode('utf-8')) / 2 ** 32
+
+def syntheticText(pmid, words):
+    '''
+    Returns a text of the given number of words, different for every pmid.
+    '''
+    generator = random.Random(int(pmid))
+    return ' '.join(generator.choice(WORDS) for _ in range(words))
+
+def syntheticDocument(pmid, abstract=True, words=200):
+    '''
+    Returns the BioC <document> of a pmid with a title and, if abstract is set, an abstract passage.
+    '''
+    title = f'Title of {pmid}: {syntheticText(pmid, 12)}'
+    passages = f'<passage><infon key="type">title</infon><offset>0</offset><text>{title}</text></passage>'
+    if abstract:
+        passages += (f'<passage><infon key="type">abstract</infon><offset>{len(title) + 1}</offset>'
+                     f'<text>{syntheticText(pmid, words)}</text></passage>')
+    return f'<document><id>{pmid}</id>{passages}</document>'
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler of the StandInServer, all settings are read from the server.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def respond(self, status, body=b'', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        start = time.monotonic()
+        match = URL_PATTERN.match(self.path)
+        if match is None:
+            server.record('not_found', start)
+            self.respond(404)
+            return
+        if not server.admit():
+            server.record('throttled', start)
+            self.respond(429, headers=[('Retry-After', str(server.retry_after))])
+            return
+        delay, error = server.draw()
+        time.sleep(delay)
+        if error:
+            server.record('errors', start)
+            self.respond(503)
+            return
+        pmids = [pmid for pmid in unquote(match.group(1)).split('|') if pmid.isdigit()]
+        documents = [syntheticDocument(pmid, pmidFraction(pmid, 'abstract') >= server.no_abstract_rate, server.words)
+                     for pmid in pmids if pmidFraction(pmid, 'missing') >= server.missing_rate]
+        body = ('<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE collection SYSTEM "BioC.dtd">'
+                f'<collection><source>PubMed</source><key>collection.key</key>{"".join(documents)}</collection>')
+        server.record('ok', start, len(documents))
+        self.respond(200, body.encode('utf-8'))
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+    Threaded HTTP server answering BioC API requests with synthetic documents.
+
+    Input:  port -> Port to listen on, 0 picks a free port (see url).
+            latency -> Mean delay of a response in seconds.
+            jitter -> Delays are drawn uniformly from latency +- jitter.
+            error_rate -> Fraction of requests failing with 503.
+            rate_limit -> Maximum number of requests per second, further requests are answered with 429. None for no limit.
+            retry_after -> Value of the Retry-After header of 429 responses in seconds.
+            missing_rate -> Fraction of pmids without API entry.
+            no_abstract_rate -> Fraction of documents without abstract.
+            words -> Number of words per abstract.
+            seed -> Seed of the latency and error draws.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=None, retry_after=1,
+                 missing_rate=0.0, no_abstract_rate=0.0, words=200, seed=0, host='127.0.0.1'):
+        super().__init__((host, port), StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.missing_rate = missing_rate
+        self.no_abstract_rate = no_abstract_rate
+        self.words = words
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = (time.monotonic(), 0)
+        self.thread = None
+        self.reset()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reset(self):
+        '''
+        Clears the request statistics.
+        '''
+        with self.lock:
+            self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'throttled': 0, 'not_found': 0,
+                          'documents': 0, 'latencies': []}
+
+    def admit(self):
+        '''
+        Counts the request in the current one-second window, False if the rate limit is exceeded.
+        '''
+        if self.rate_limit is None:
+            return True
+        with self.lock:
+            start, count = self.window
+            now = time.monotonic()
+            if now - start >= 1:
+                start, count = now, 0
+            self.window = (start, count + 1)
+            return count < self.rate_limit
+
+    def draw(self):
+        '''
+        Returns the (delay, error) of a request.
+        '''
+        with self.lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            return delay, self.random.random() < self.error_rate
+
+    def record(self, outcome, start, documents=0):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats[outcome] += 1
+            self.stats['documents'] += documents
+            self.stats['latencies'].append(time.monotonic() - start)
+
+    def start(self):
+        '''
+        Serves requests in a background thread, returns the server.
+        '''
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Mean delay of a response in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Delays are drawn uniformly from latency +- jitter')
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help='Fraction of requests failing with 503')
+    parser.add_argument('--rate_limit', type=float, default=None,
+                        help='Maximum number of requests per second before answering with 429')
+    parser.add_argument('--missing_rate', type=float, default=0.0,
+                        help='Fraction of pmids without API entry')
+    parser.add_argument('--no_abstract_rate', type=float, default=0.0,
+                        help='Fraction of documents without abstract')
+    parser.add_argument('--words', type=int, default=200,
+                        help='Number of words per abstract')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    server = StandInServer(args.port, args.latency, args.jitter, args.error_rate, args.rate_limit,
+                           missing_rate=args.missing_rate, no_abstract_rate=args.no_abstract_rate, words=args.words)
+    logging.info(f'Serving the BioC API stand-in at {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
@@ -0,0 +1,185 @@
+import os
+import re
+import gzip
+import time
+import zlib
+import sqlite3
+import logging
+import xml.etree.cElementTree as et
+
+'''
+Persistent per-PMID cache of retrieved BioC documents. Chunk responses are split into
+their documents, every requested PMID gets a status row:
+
+    ok                  the document has a title and an abstract
+    no_title_abstract   the document misses the title or the abstract
+    no_api_entry        the API returned no document for the PMID
+
+so that later runs only request PMIDs which are not cached yet or whose entry has expired.
+
+Documents are cached in the compact form of raw responses, whatever form the chunk file
+was retrieved in, so the exported chunk files are always read with processPMID(compact=True).
+'''
+
+# Version of the cached document form, caches of version 0 may hold prettified documents.
+CACHE_VERSION = 1
+
+OK = 'ok'
+NO_TITLE_ABSTRACT = 'no_title_abstract'
+NO_API_ENTRY = 'no_api_entry'
+
+def documentStatus(document):
+    '''
+    Classifies a BioC document the same way processPMID does (two passages with two texts).
+    '''
+    element_lst = [element.tag for element in document.iter()]
+    if element_lst.count('passage') == 2 and element_lst.count('text') == 2:
+        return OK
+    return NO_TITLE_ABSTRACT
+
+def compactDocument(document):
+    '''
+    Converts a document prettified by requestAPI into the form of a raw response, in place.
+    The values get the same whitespace removal as the prettified parser of processPMID applies,
+    the indentation between the elements is removed. Documents which are already compact are left as they are.
+    '''
+    id = document.find('id')
+    if id is None or id.text is None or id.text == id.text.strip():
+        return document
+    for element in document.iter():
+        if element.tag == 'infon':
+            element.text = re.sub(r"\n+\s+", "", element.text or '')
+        elif element.tag in ('id', 'text'):
+            element.text = re.sub(r"\n+", "", element.text or '').strip(' ')
+        elif len(element):
+            element.text = element.text if element.text and element.text.strip() else None
+        elif element.text is not None:
+            element.text = element.text.strip()
+        element.tail = None
+    return document
+
+class RetrievalCache:
+    '''
+    SQLite store of BioC documents and misses by PMID.
+
+    Input:  filepath -> Path to the SQLite cache file, created if it does not exist.
+            ttl -> Seconds after which retrieved documents expire, None to keep them forever.
+            miss_ttl -> Seconds after which "no API entry" records expire, None to keep them forever.
+    '''
+    def __init__(self, filepath, ttl=None, miss_ttl=7 * 24 * 3600):
+        self.filepath = filepath
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS documents (
+                                       pmid TEXT PRIMARY KEY,
+                                       status TEXT NOT NULL,
+                                       document BLOB,
+                                       retrieved REAL NOT NULL)''')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < CACHE_VERSION:
+            self.upgrade()
+
+    def upgrade(self):
+        '''
+        Converts the documents of a cache written before the documents were stored in compact form.
+        '''
+        rows = []
+        for pmid, document in self.connection.execute('SELECT pmid, document FROM documents WHERE document IS NOT NULL'):
+            element = compactDocument(et.fromstring(zlib.decompress(document)))
+            rows.append((zlib.compress(et.tostring(element, encoding='unicode').encode('utf-8'), 1), pmid))
+        self.connection.executemany('UPDATE documents SET document = ? WHERE pmid = ?', rows)
+        self.connection.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.connection.commit()
+
+    def expired(self, status, retrieved, now):
+        ttl = self.miss_ttl if status == NO_API_ENTRY else self.ttl
+        return ttl is not None and now - retrieved > ttl
+
+    def missing(self, pmidList):
+        '''
+        Returns the pmids of pmidList (in order) which are not cached or whose entry has expired.
+        '''
+        now = time.time()
+        cached = set()
+        pmids = [str(pmid) for pmid in pmidList]
+        for i in range(0, len(pmids), 900):
+            chunk = pmids[i:i + 900]
+            rows = self.connection.execute(f"SELECT pmid, status, retrieved FROM documents WHERE pmid IN ({','.join('?' * len(chunk))})", chunk)
+            cached.update(pmid for pmid, status, retrieved in rows if not self.expired(status, retrieved, now))
+        return [pmid for pmid in pmidList if str(pmid) not in cached]
+
+    def ingestChunk(self, xml_file, pmid_chunk):
+        '''
+        Splits a retrieved chunk file into its documents and records the pmids of the chunk without document
+        as "no API entry". Chunk files which are missing, cannot be parsed or are no BioC <collection> (i.e. an
+        error page) are not recorded, so their pmids are requested again by the next run.
+
+        Output: True if the chunk was recorded.
+        '''
+        if not os.path.exists(xml_file):
+            return False
+        now = time.time()
+        rows = []
+        root = None
+        try:
+            with (gzip.open if xml_file.endswith('.gz') else open)(xml_file, 'rb') as f:
+                for event, element in et.iterparse(f, events=('start', 'end')):
+                    if event == 'start':
+                        if root is None:
+                            root = element.tag
+                            if root != 'collection':
+                                logging.error(f'{xml_file} is no BioC collection, its pmids are requested again.')
+                                return False
+                    elif element.tag == 'document':
+                        pmid = re.sub(r"\s+", "", element.findtext('id', ''))
+                        compactDocument(element)
+                        document = zlib.compress(et.tostring(element, encoding='unicode').encode('utf-8'), 1)
+                        rows.append((pmid, documentStatus(element), document, now))
+                        element.clear()
+        except (et.ParseError, EOFError, OSError):
+            logging.error(f'Could not parse {xml_file}, its pmids are requested again.')
+            return False
+        found = {row[0] for row in rows}
+        rows += [(str(pmid), NO_API_ENTRY, None, now) for pmid in pmid_chunk if str(pmid) not in found]
+        self.connection.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)", rows)
+        self.connection.commit()
+        return True
+
+    def exportChunks(self, pmidList, outputFolder, chunk_size=400):
+        '''
+        Writes the cached documents of pmidList into chunk files '{outputFolder}/chunk-{i}.xml' for processPMID.
+        PMIDs without document are left out, like in a response of the API. The documents are looked up in
+        batches and every chunk is written once it is complete, so only one chunk is held in memory.
+        '''
+        chunks = 0
+        documents = []
+
+        def writeChunk():
+            with open(f'{outputFolder}/chunk-{chunks}.xml', 'wb') as f:
+                f.write(b'<?xml version="1.0" encoding="utf-8"?>\n<collection>\n')
+                f.writelines(documents)
+                f.write(b'</collection>\n')
+
+        pmids = list(dict.fromkeys(str(pmid) for pmid in pmidList))
+        for i in range(0, len(pmids), 900):
+            batch = pmids[i:i + 900]
+            rows = dict(self.connection.execute(f"SELECT pmid, document FROM documents WHERE pmid IN ({','.join('?' * len(batch))}) AND document IS NOT NULL", batch))
+            for pmid in batch:
+                if pmid in rows:
+                    documents.append(zlib.decompress(rows[pmid]))
+                    if len(documents) == chunk_size:
+                        writeChunk()
+                        chunks += 1
+                        documents = []
+        if documents or not chunks:
+            writeChunk()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
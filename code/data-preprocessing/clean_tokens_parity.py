@@ -0,0 +1,107 @@
+import os
+import re
+import csv
+import sys
+import logging
+import argparse
+
+from preprocessing import NON_WORD_PATTERN, clean_tokens
+
+"""
+Parity check of clean_tokens against its original per-character implementation.
+
+Both implementations clean the whitespace separated tokens of the titles and
+abstracts of a documents TSV, every single character occurring in it and a few
+edge cases (empty and whitespace tokens, non-ASCII letters and digits, non-string
+tokens). The sample documents are checked by default, the script exits with 1
+if any output differs:
+
+    python clean_tokens_parity.py --input documents.tsv
+"""
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "data", "output",
+                             "sample-files", "tsv", "documents_20220822.tsv")
+EDGE_CASES = ["", " ", "\t\n", "-", "--", "a-b", "(2+)", "Zn(2+)-dependent", "α-helix", "naïve", "café",
+              "١٢٣", "²", "Ⅻ", "_", "a_b", "x​y", "’s", "e.g.", "p<0.05", 42, 3.5, None]
+
+
+def original_clean_tokens(tokens):
+    """
+    clean_tokens as it was before NON_WORD_PATTERN, matching every character on its own.
+    """
+    letters_pattern = r'.*[a-zA-Z\d\-].*' #Includes all letters which are numbers, letters or a hyphen.
+    iteration = 0
+    while(iteration < len(tokens)):
+        word = "".join([c for c in str(tokens[iteration]) if re.match(letters_pattern, c)])
+        tokens[iteration] = word
+        iteration += 1
+    cleaned = []
+    for word in tokens:
+        if word != "":
+            cleaned.append(word)
+    return cleaned
+
+
+def read_tokens(filepath: str):
+    """
+    Yields the whitespace separated tokens of the titles and abstracts of a documents TSV, one list per text.
+    """
+    with open(filepath, newline="", encoding="utf-8") as file:
+        reader = csv.reader(file, delimiter="\t")
+        next(reader, None)
+        for row in reader:
+            for text in row[1:3]:
+                yield text.split()
+
+
+def compare(tokens: list) -> bool:
+    """
+    Returns True if both implementations clean the tokens identically, logs the difference otherwise.
+    """
+    expected = original_clean_tokens(list(tokens))
+    cleaned = clean_tokens(list(tokens))
+    if cleaned != expected:
+        logging.error(f"Mismatch for {tokens!r}: {cleaned!r} instead of {expected!r}.")
+        return False
+    return True
+
+
+def check_parity(filepath: str) -> bool:
+    """
+    Compares both implementations on the documents TSV, its characters and the edge cases.
+
+    Returns
+    -------
+    bool:
+        True if all outputs are identical.
+    """
+    characters = set()
+    texts = tokens = 0
+    identical = True
+    for text in read_tokens(filepath):
+        identical &= compare(text)
+        characters.update("".join(text))
+        texts += 1
+        tokens += len(text)
+    for character in sorted(characters):
+        identical &= compare([character])
+    identical &= compare(EDGE_CASES)
+    identical &= all(compare([token]) for token in EDGE_CASES)
+    logging.info(f"Compared {tokens} tokens of {texts} texts, {len(characters)} distinct characters "
+                 f"and {len(EDGE_CASES)} edge cases with NON_WORD_PATTERN {NON_WORD_PATTERN.pattern}.")
+    return identical
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--input", type=str, default=DEFAULT_INPUT,
+                        help="Path to a documents TSV with PMID, title and abstract columns")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if check_parity(args.input):
+        logging.info("clean_tokens is identical to the original implementation.")
+        sys.exit(0)
+    logging.error("clean_tokens differs from the original implementation.")
+    sys.exit(1)
@@ -0,0 +1,287 @@
+import os
+import struct
+import logging
+
+import numpy as np
+import pandas as pd
+
+"""
+Binary ground truth store for the RELISH relevance pairs.
+
+The store is a single file written next to RELISH.tsv (RELISH.qrels) holding a
+fixed size header followed by packed columns, all sorted by reference and
+assessed PMID:
+
+    header        64 bytes: magic, version, number of pairs, number of references
+    refs          int32[references]       unique reference PMIDs
+    ref_offsets   int64[references + 1]   first row of every reference PMID
+    ref_pmid      int32[pairs]
+    assess_pmid   int32[pairs]
+    relevance     int8[pairs]
+
+Loading the store memory-maps the columns, so reading the ground truth does not
+parse any text and the pages are shared between processes.
+"""
+
+MAGIC = b"RELQRELS"
+VERSION = 1
+HEADER = struct.Struct("<8sIQQ")
+HEADER_SIZE = 64
+COLUMN_NAMES = ["PMID1", "PMID2", "Relevance"]
+
+
+def _aligned(offset: int, alignment: int = 8) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _layout(num_pairs: int, num_refs: int) -> dict:
+    """
+    Computes the byte offset of every column in the store.
+
+    Parameters
+    ----------
+    num_pairs: int
+        Number of PMID pairs in the store.
+    num_refs: int
+        Number of unique reference PMIDs in the store.
+
+    Returns
+    -------
+    layout: dict
+        Mapping of column name to (offset, dtype, length).
+    """
+    columns = [("refs", np.int32, num_refs),
+               ("ref_offsets", np.int64, num_refs + 1),
+               ("ref_pmid", np.int32, num_pairs),
+               ("assess_pmid", np.int32, num_pairs),
+               ("relevance", np.int8, num_pairs)]
+    layout = {}
+    offset = HEADER_SIZE
+    for name, dtype, length in columns:
+        offset = _aligned(offset)
+        layout[name] = (offset, dtype, length)
+        offset += np.dtype(dtype).itemsize * length
+    return layout
+
+
+def qrels_path(filepath: str) -> str:
+    """
+    Returns the path of the binary store that belongs to a ground truth TSV file.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the ground truth TSV file, i.e. "data/input/RELISH.tsv".
+
+    Returns
+    -------
+    str:
+        Path to the binary store, i.e. "data/input/RELISH.qrels".
+    """
+    return os.path.splitext(filepath)[0] + ".qrels"
+
+
+def write_ground_truth(filepath: str, ref_pmid, assess_pmid, relevance) -> None:
+    """
+    Writes the relevance pairs into the binary ground truth store.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the output store.
+    ref_pmid: array-like
+        Reference PMIDs.
+    assess_pmid: array-like
+        Assessed PMIDs.
+    relevance: array-like
+        Relevance score (0, 1 or 2) of every pair.
+    """
+    ref_pmid = np.asarray(ref_pmid, dtype=np.int32)
+    assess_pmid = np.asarray(assess_pmid, dtype=np.int32)
+    relevance = np.asarray(relevance, dtype=np.int8)
+
+    order = np.lexsort((assess_pmid, ref_pmid))
+    columns = {"ref_pmid": ref_pmid[order],
+               "assess_pmid": assess_pmid[order],
+               "relevance": relevance[order]}
+    refs, starts = np.unique(columns["ref_pmid"], return_index=True)
+    columns["refs"] = refs.astype(np.int32)
+    columns["ref_offsets"] = np.append(starts, len(order)).astype(np.int64)
+
+    layout = _layout(len(order), len(refs))
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(order), len(refs)).ljust(HEADER_SIZE, b"\0"))
+        for name, (offset, dtype, _) in layout.items():
+            file.write(b"\0" * (offset - file.tell()))
+            file.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+    os.replace(tmp_filepath, filepath)
+
+
+def convert_tsv(filepath: str, output_file: str = None) -> str:
+    """
+    Parses a RELISH ground truth TSV file (3 columns without header) and writes
+    its binary store.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the ground truth TSV file.
+    output_file: str
+        Path to the output store. Defaults to the TSV path with a .qrels extension.
+
+    Returns
+    -------
+    output_file: str
+        Path to the written store.
+    """
+    output_file = output_file or qrels_path(filepath)
+    data = pd.read_csv(filepath, sep="\t", header=None, names=COLUMN_NAMES,
+                       dtype={"PMID1": np.int32, "PMID2": np.int32, "Relevance": np.int8})
+    write_ground_truth(output_file, data["PMID1"].values, data["PMID2"].values, data["Relevance"].values)
+    return output_file
+
+
+class GroundTruth:
+    """
+    Read-only, memory-mapped view of a binary ground truth store.
+
+    Attributes
+    ----------
+    ref_pmid, assess_pmid, relevance: numpy.memmap
+        Columns of the store, sorted by reference and assessed PMID.
+    refs: numpy.memmap
+        Sorted unique reference PMIDs.
+    ref_offsets: numpy.memmap
+        Row range of every reference PMID: rows ref_offsets[i] to ref_offsets[i + 1].
+    """
+
+    def __init__(self, filepath: str):
+        with open(filepath, "rb") as file:
+            magic, version, num_pairs, num_refs = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{filepath} is not a RELISH ground truth store.")
+        self.filepath = filepath
+        for name, (offset, dtype, length) in _layout(num_pairs, num_refs).items():
+            if length:
+                column = np.memmap(filepath, dtype=dtype, mode="r", offset=offset, shape=(length,))
+            else:
+                column = np.empty(0, dtype=dtype)
+            setattr(self, name, column)
+
+    def __len__(self) -> int:
+        return len(self.ref_pmid)
+
+    def assessments(self, ref_pmid: int):
+        """
+        Returns the assessed PMIDs and relevance scores of one reference PMID.
+
+        Parameters
+        ----------
+        ref_pmid: int
+            Reference PMID.
+
+        Returns
+        -------
+        assess_pmid, relevance: numpy.ndarray
+            Views on the store, empty if the reference PMID is not part of it.
+        """
+        index = np.searchsorted(self.refs, ref_pmid)
+        if index == len(self.refs) or self.refs[index] != ref_pmid:
+            return self.assess_pmid[:0], self.relevance[:0]
+        start, end = self.ref_offsets[index], self.ref_offsets[index + 1]
+        return self.assess_pmid[start:end], self.relevance[start:end]
+
+    def lookup(self, ref_pmid, assess_pmid) -> np.ndarray:
+        """
+        Vectorized relevance lookup for arrays of PMID pairs.
+
+        Parameters
+        ----------
+        ref_pmid: array-like
+            Reference PMIDs.
+        assess_pmid: array-like
+            Assessed PMIDs.
+
+        Returns
+        -------
+        relevance: numpy.ndarray
+            Relevance score of every pair, -1 if the pair is not assessed.
+        """
+        keys = (self.ref_pmid.astype(np.int64) << 32) | self.assess_pmid
+        queries = (np.asarray(ref_pmid, dtype=np.int64) << 32) | np.asarray(assess_pmid, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(keys, queries), max(len(keys) - 1, 0))
+        relevance = np.full(len(queries), -1, dtype=np.int8)
+        if len(keys):
+            found = keys[positions] == queries
+            relevance[found] = self.relevance[positions[found]]
+        return relevance
+
+    def to_dataframe(self, columns: list = COLUMN_NAMES) -> pd.DataFrame:
+        """
+        Wraps the columns of the store in a dataframe.
+
+        Parameters
+        ----------
+        columns: list
+            Names for the reference PMID, assessed PMID and relevance columns.
+
+        Returns
+        -------
+        pd.DataFrame:
+            Dataframe with the three ground truth columns.
+        """
+        return pd.DataFrame(dict(zip(columns, (self.ref_pmid, self.assess_pmid, self.relevance))), copy=False)
+
+
+def load_ground_truth(filepath: str) -> GroundTruth:
+    """
+    Memory-maps the ground truth. If a TSV file is given, its binary store next
+    to it is used, and (re)built first when it is missing or older than the TSV.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to either the binary store or the ground truth TSV file.
+
+    Returns
+    -------
+    GroundTruth:
+        Memory-mapped ground truth.
+    """
+    if filepath.endswith(".qrels"):
+        return GroundTruth(filepath)
+
+    store = qrels_path(filepath)
+    if not os.path.exists(store) or os.path.getmtime(store) < os.path.getmtime(filepath):
+        logging.info(f"Building binary ground truth store {store}.")
+        convert_tsv(filepath, store)
+    return GroundTruth(store)
+
+
+def attach_relevance(data: pd.DataFrame, ground_truth: GroundTruth,
+                     pmid_columns: list = COLUMN_NAMES[:2], relevance_column: str = "Relevance") -> pd.DataFrame:
+    """
+    Sets the relevance column of a dataframe of PMID pairs (i.e. a cosine
+    similarity matrix) from the ground truth. Pairs without an assessment are
+    dropped.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Dataframe containing a reference and an assessed PMID column.
+    ground_truth: GroundTruth
+        Memory-mapped ground truth.
+    pmid_columns: list
+        Names of the reference and assessed PMID columns.
+    relevance_column: str
+        Name of the relevance column to set.
+
+    Returns
+    -------
+    data: pd.DataFrame
+        Dataframe of the assessed pairs with their relevance column.
+    """
+    relevance = ground_truth.lookup(data[pmid_columns[0]].values, data[pmid_columns[1]].values)
+    data = data.assign(**{relevance_column: relevance})
+    return data[relevance >= 0].reset_index(drop=True)
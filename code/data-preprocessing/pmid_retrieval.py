@@ -1,8 +1,14 @@
 import pandas as pd
+import numpy as np
 import sys
 import logging
 import json
 import os
+import re
+from ground_truth import write_ground_truth, qrels_path
+
+RELEVANCE_LABELS = (('relevant', 2), ('partial', 1), ('irrelevant', 0))
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
 
 def parseRelish(filepath):
     '''
@@ -52,6 +58,9 @@ def parseRelish(filepath):
             df = df.drop_duplicates(subset=['ref_pmid', 'assess_pmid'], keep=False)
             # Save tsv to input folder
             df.to_csv(f'{os.path.dirname(filepath)}/RELISH.tsv', sep='\t', index=False, header=False)
+            # Save the binary ground truth store next to the tsv
+            write_ground_truth(qrels_path(f'{os.path.dirname(filepath)}/RELISH.tsv'),
+                               df['ref_pmid'].astype(int), df['assess_pmid'].astype(int), df['relevance'])
             # Create tsv with alternative assessment !!!!!! FOR INTERNAL USE ONLY !!!!!!
             # df_alternate = df.copy()
             # df_alternate['relevance'] = df_alternate['relevance'].apply(lambda x: 1 if (x == 2) | (x == 1) else 0)
@@ -62,6 +71,142 @@ def parseRelish(filepath):
             logging.error("Input file directory not found.", exc_info=True)
         return set(pmidList)
 
+def _iterJsonArray(data_file, chunk_size=1 << 20):
+    '''
+    Generator that incrementally decodes the elements of a top-level JSON array
+    without loading the whole file into memory.
+
+    Input:  data_file -> Text file object positioned at the start of the JSON document.
+            chunk_size -> Number of characters read from the file at a time.
+    Output: Yields every element of the array in file order.
+    '''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    opened = False
+    while True:
+        position = _JSON_WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            chunk = data_file.read(chunk_size)
+            if not chunk:
+                if opened:
+                    raise ValueError("Unterminated JSON array.")
+                return
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        char = buffer[position]
+        if not opened:
+            if char != '[':
+                raise ValueError("JSON document is not an array.")
+            opened = True
+            position += 1
+        elif char == ']':
+            return
+        elif char == ',':
+            position += 1
+        else:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The element is cut off at the end of the buffer, read more of the file.
+                chunk = data_file.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield element
+            position = end
+
+def _growColumns(columns, size):
+    '''
+    Reallocates the typed columns of parseRelishStream to at least the given size,
+    doubling the capacity to keep appends amortized linear.
+
+    Input:  columns -> Tuple of numpy arrays sharing the same length.
+            size -> Minimum number of rows the columns have to hold.
+    Output: Tuple of numpy arrays with the previous content copied over.
+    '''
+    capacity = len(columns[0])
+    while capacity < size:
+        capacity *= 2
+    grown = []
+    for column in columns:
+        new_column = np.empty(capacity, dtype=column.dtype)
+        new_column[:len(column)] = column
+        grown.append(new_column)
+    return tuple(grown)
+
+def parseRelishStream(filepath, chunk_size=1 << 20):
+    '''
+    Streaming variant of parseRelish. Parses the RELISH json file entry by entry
+    into preallocated typed columns (int32 pmids, int8 relevance) and resolves
+    duplicates in a vectorized way, so that the run time grows linearly with the
+    number of judgments. Writes the same RELISH.tsv and RELISH_duplicates.tsv as
+    parseRelish.
+
+    Input:  filepath -> String: Filepath to the RELISH json file
+            i.e. "RELISH/data/RELISH.json".
+            chunk_size -> Int: Number of characters read from the json file at a time.
+    Output: A set contaning a pmid for each row.
+    '''
+    if not isinstance(filepath, str):
+        logging.alert("Wrong parameter type for parseRelishStream.")
+        sys.exit("filepath needs to be of type String")
+    else:
+        try:
+            columns = (np.empty(1 << 16, dtype=np.int32),
+                       np.empty(1 << 16, dtype=np.int32),
+                       np.empty(1 << 16, dtype=np.int8))
+            count = 0
+            with open(filepath) as data_file:
+                for entry in _iterJsonArray(data_file, chunk_size):
+                    pmid = int(entry['pmid'])
+                    response = entry['response']
+                    for label, score in RELEVANCE_LABELS:
+                        assessed = response.get(label, [])
+                        if not assessed:
+                            continue
+                        end = count + len(assessed)
+                        if end > len(columns[0]):
+                            columns = _growColumns(columns, end)
+                        ref_pmid, assess_pmid, relevance = columns
+                        ref_pmid[count:end] = pmid
+                        assess_pmid[count:end] = np.array(assessed, dtype=np.int32)
+                        relevance[count:end] = score
+                        count = end
+            ref_pmid, assess_pmid, relevance = (column[:count] for column in columns)
+            # Pack each judgment into a single 64 bit key: 31 bits per pmid and 2 bits for the relevance.
+            keys = (ref_pmid.astype(np.uint64) << np.uint64(33)) \
+                | (assess_pmid.astype(np.uint64) << np.uint64(2)) \
+                | relevance.astype(np.uint64)
+            # Delete duplicates where assessment is the same. Keep first instance.
+            _, first_rows = np.unique(keys, return_index=True)
+            kept_rows = np.sort(first_rows)
+            # Delete remaining duplicates where pmid and assess_pmid is the same but not the assessment. Keep non of them.
+            _, inverse, counts = np.unique(keys[kept_rows] >> np.uint64(2), return_inverse=True, return_counts=True)
+            conflicting = counts[inverse.ravel()] > 1
+            duplicate_rows = kept_rows[conflicting]
+            kept_rows = kept_rows[~conflicting]
+            duplicates = pd.DataFrame({'ref_pmid': ref_pmid[duplicate_rows],
+                                       'assess_pmid': assess_pmid[duplicate_rows],
+                                       'relevance': relevance[duplicate_rows]})
+            duplicates.to_csv(f'{os.path.dirname(filepath)}/RELISH_duplicates.tsv', sep='\t', index=False)
+            # Save tsv to input folder
+            df = pd.DataFrame({'ref_pmid': ref_pmid[kept_rows],
+                               'assess_pmid': assess_pmid[kept_rows],
+                               'relevance': relevance[kept_rows]})
+            df.to_csv(f'{os.path.dirname(filepath)}/RELISH.tsv', sep='\t', index=False, header=False)
+            # Save the binary ground truth store next to the tsv
+            write_ground_truth(qrels_path(f'{os.path.dirname(filepath)}/RELISH.tsv'),
+                               df['ref_pmid'].values, df['assess_pmid'].values, df['relevance'].values)
+            # Create a list of all pmids for further processing
+            pmidList = [str(pmid) for pmid in np.unique(assess_pmid[kept_rows])]
+        except Exception:
+            logging.error("Input file directory not found.", exc_info=True)
+        return set(pmidList)
+
 def parseTREC(filepath):
     '''
     Function to create a list of all pmids included in the TREC tsv file
@@ -1,14 +1,143 @@
+import argparse
 import csv
+import json
 import logging
+import os
 import re
+import shutil
+import socket
 import sys
+from itertools import islice
 import spacy
 import numpy as np
 from nltk import download
 from nltk.corpus import stopwords
+from token_corpus import write_corpus
+from token_cache import TokenCache, cache_key
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pmid-store'))
+from pmid_registry import PMIDRegistry, TOKENIZATION, TOKENIZED
 
 # Download using "pip install https://s3-us-west-2.amazonaws.com/ai2-s2-scispacy/releases/v0.5.0/en_core_sci_lg-0.5.0.tar.gz"
-nlp = spacy.load("en_core_sci_lg")  # Scispacy model en_core_sci_lg
+MODEL = "en_core_sci_lg"  # Scispacy model en_core_sci_lg
+nlp = None  # Loaded on first use by load_model
+
+# Address of the tokenization server (see tokenization_server.py): a Unix socket path or host:port.
+DEFAULT_SERVER_ADDRESS = os.environ.get("RELISH_TOKENIZER_SERVER",
+                                        "/tmp/relish_tokenizer.sock" if hasattr(socket, "AF_UNIX") else "localhost:8765")
+server = None  # TokenizerClient used instead of the in-process model once connect_server succeeded
+
+# Pipeline components needed to find the entities that get_tokens merges, all others are disabled in batched mode.
+ENTITY_COMPONENTS = ("tok2vec", "ner")
+
+# Number of documents looked up in the token cache at once by tokenize_cached.
+CACHE_WINDOW = 10000
+
+# Matches all characters which are not numbers, letters or a hyphen.
+NON_WORD_PATTERN = re.compile(r'[^a-zA-Z\d\-]+')
+
+def load_model():
+    '''
+    Loads the ScispaCy model into the process on first use.
+
+    Returns
+    -------
+    nlp: spacy.language.Language
+        The loaded model.
+    '''
+    global nlp
+    if nlp is None:
+        nlp = spacy.load(MODEL)
+    return nlp
+
+def parse_address(address):
+    '''
+    Parses the address of the tokenization server.
+
+    Parameters
+    ----------
+    address: str
+        Either a Unix socket path or host:port.
+    Returns
+    -------
+    family, address: tuple
+        Socket family and the address in the form expected by the socket module.
+    '''
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and "/" not in address:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+class TokenizerClient:
+    '''
+    Client of the tokenization server. Requests and responses are exchanged as one JSON object per line.
+
+    Parameters
+    ----------
+    address: str
+        Either a Unix socket path or host:port of the server.
+    '''
+    def __init__(self, address=DEFAULT_SERVER_ADDRESS):
+        family, address = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(address)
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile("rwb")
+
+    def request(self, method, texts=()):
+        '''
+        Sends a batch of texts to the server.
+
+        Parameters
+        ----------
+        method: str
+            "tokens" for the get_tokens output, "clean" for the cleaned tokens or "model" for the model name.
+        texts: list
+            Texts to be tokenized.
+        Returns
+        -------
+        result: list or str
+            A list of tokens per text, or the model name.
+        '''
+        self.file.write(json.dumps({"method": method, "texts": list(texts)}).encode("utf-8") + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("Tokenization server closed the connection.")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Tokenization server error: {response['error']}")
+        return response["result"]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+def connect_server(address=None):
+    '''
+    Connects to a running tokenization server, which is then used instead of loading the model.
+
+    Parameters
+    ----------
+    address: str
+        Either a Unix socket path or host:port of the server, defaults to DEFAULT_SERVER_ADDRESS.
+    Returns
+    -------
+    connected: bool
+        False if no server is running, the model is then loaded in-process on first use.
+    '''
+    global server
+    address = address or DEFAULT_SERVER_ADDRESS
+    try:
+        server = TokenizerClient(address)
+        logging.info(f"Using tokenization server at {address}.")
+    except OSError:
+        server = None
+        logging.info(f"No tokenization server at {address}, loading the model in-process.")
+    return server is not None
 
 def get_entities(doc):
     '''
@@ -40,8 +169,27 @@ def get_tokens(text):
     tokens: list
         A list of tokens.
     '''
+    if server is not None:
+        return server.request("tokens", [text])[0]
+    doc = load_model()(text)
+
+    return get_doc_tokens(doc)
+
+def get_doc_tokens(doc):
+    '''
+    Retrieves the tokens of an already processed text, keeping the words of every
+    entity as separate tokens.
+
+    Parameters
+    ----------
+    doc: spacy.tokens.doc.Doc
+        Sequence of Token objects from ScispaCy.
+    Returns
+    -------
+    tokens: list
+        A list of tokens.
+    '''
     tokens = []
-    doc = nlp(text)
 
     # Get entities in the text
     text_ents = get_entities(doc)
@@ -68,7 +216,250 @@ def get_tokens(text):
 
     return tokens
 
-def preprocessPhrases(filepathIn=None, filepathOut=None):
+def read_documents(filepathIn):
+    '''
+    Reads the TREC or RELISH tsv file and yields its documents in lowercase.
+
+    Parameters
+    ----------
+    filepathIn: str
+        The input file for the RELISH or TREC tsv to be transformed.
+    Returns
+    -------
+    documents: generator
+        Tuples of (pmid, title, abstract) for every row after the header line.
+    '''
+    with open(filepathIn) as input:
+        inputFile = csv.reader(input, delimiter="\t")
+        next(inputFile, None)
+        for line in inputFile:
+            yield line[0], line[1].lower(), line[2].lower()
+
+def read_pmids(filepathIn):
+    '''
+    Reads the pmids of the TREC or RELISH tsv file, without the titles and abstracts.
+    '''
+    with open(filepathIn) as input:
+        inputFile = csv.reader(input, delimiter="\t")
+        next(inputFile, None)
+        return [line[0] for line in inputFile]
+
+def tokenize_documents(documents, batch_size=256, n_process=1):
+    '''
+    Tokenizes titles and abstracts in batches with nlp.pipe, optionally over several processes.
+    Only the pipeline components needed for the entities are run, the result is the same as
+    calling get_tokens on every text.
+
+    Parameters
+    ----------
+    documents: iterable
+        Tuples of (pmid, title, abstract).
+    batch_size: int
+        Number of texts processed by spaCy per batch.
+    n_process: int
+        Number of processes used by spaCy, -1 uses all available cores.
+    Returns
+    -------
+    documents: generator
+        Tuples of (pmid, title tokens, abstract tokens) in input order, where the tokens are strings.
+    '''
+    texts = ((text, (pmid, field)) for pmid, title, abstract in documents
+             for field, text in (("title", title), ("abstract", abstract)))
+    nlp = load_model()
+    disable = [name for name in nlp.pipe_names if name not in ENTITY_COMPONENTS]
+    docs = nlp.pipe(texts, as_tuples=True, batch_size=batch_size, n_process=n_process, disable=disable)
+    for title_doc, (pmid, _) in docs:
+        abstract_doc, _ = next(docs)
+        yield (pmid,
+               [str(token) for token in get_doc_tokens(title_doc)],
+               [str(token) for token in get_doc_tokens(abstract_doc)])
+
+def tokenize_texts(texts, batch_size=256):
+    '''
+    Tokenizes a batch of texts in-process, with the same result as calling get_tokens on every text.
+
+    Parameters
+    ----------
+    texts: list
+        Plain texts that are to be tokenized.
+    batch_size: int
+        Number of texts processed by spaCy per batch.
+    Returns
+    -------
+    tokens: list
+        A list of tokens as strings for every text.
+    '''
+    nlp = load_model()
+    disable = [name for name in nlp.pipe_names if name not in ENTITY_COMPONENTS]
+    return [[str(token) for token in get_doc_tokens(doc)]
+            for doc in nlp.pipe(texts, batch_size=batch_size, disable=disable)]
+
+def tokenize_remote(documents, batch_size=256):
+    '''
+    Tokenizes titles and abstracts on the tokenization server, sending batch_size documents per request.
+
+    Parameters
+    ----------
+    documents: iterable
+        Tuples of (pmid, title, abstract).
+    batch_size: int
+        Number of documents per request.
+    Returns
+    -------
+    documents: generator
+        Tuples of (pmid, title tokens, abstract tokens) in input order, where the tokens are strings.
+    '''
+    documents = iter(documents)
+    for batch in iter(lambda: list(islice(documents, batch_size)), []):
+        tokens = server.request("tokens", [text for _, title, abstract in batch for text in (title, abstract)])
+        for index, (pmid, _, _) in enumerate(batch):
+            yield pmid, tokens[2 * index], tokens[2 * index + 1]
+
+def clean_tokens(tokens):
+    '''
+    Removes all characters aside from letters, numbers and the hyphen from every token
+    and drops the tokens that end up empty.
+
+    Parameters
+    ----------
+    tokens: list
+        A list of tokens.
+    Returns
+    -------
+    cleaned: list
+        A list of the cleaned tokens as strings.
+    '''
+    return [word for word in (NON_WORD_PATTERN.sub("", str(token)) for token in tokens) if word]
+
+def model_name():
+    '''
+    Returns the name and version of the loaded ScispaCy model, i.e. "en_core_sci_lg-0.5.0".
+    '''
+    if server is not None:
+        return server.request("model")
+    if nlp is None:
+        # Read from the package metadata, so that a run served from the token cache does not load the model.
+        version = spacy.util.get_package_version(MODEL)
+        if version is not None:
+            return f"{MODEL}-{version}"
+    return loaded_model_name()
+
+def loaded_model_name():
+    '''
+    Returns the name and version of the in-process ScispaCy model, loading it if needed.
+    '''
+    meta = load_model().meta
+    return f"{meta['lang']}_{meta['name']}-{meta['version']}"
+
+def tokenize(documents, batch_size=None, n_process=1):
+    '''
+    Tokenizes documents one by one with get_tokens or, if a batch size is given, with tokenize_documents.
+    Uses the tokenization server instead if connected.
+    '''
+    if server is not None:
+        return tokenize_remote(documents, batch_size or 256)
+    if batch_size:
+        return tokenize_documents(documents, batch_size, n_process)
+    return ((pmid, get_tokens(title), get_tokens(abstract)) for pmid, title, abstract in documents)
+
+def tokenize_cached(documents, cache, batch_size=None, n_process=1):
+    '''
+    Looks up every document in the token cache and only tokenizes the cache misses,
+    which are stored in the cache afterwards. The input order is preserved.
+
+    Parameters
+    ----------
+    documents: iterable
+        Tuples of (pmid, title, abstract).
+    cache: TokenCache
+        Cache of cleaned tokens.
+    batch_size: int
+        If given, the texts are tokenized in batches of this size with nlp.pipe instead of one by one.
+    n_process: int
+        Number of processes used for the batched tokenization.
+    Returns
+    -------
+    documents: generator
+        Tuples of (pmid, cleaned title tokens, cleaned abstract tokens).
+    '''
+    model = model_name()
+    documents = iter(documents)
+    # Documents are looked up and tokenized in windows, so that at most one window is held in memory
+    # however the cache hits and misses are distributed over the input.
+    window = max(CACHE_WINDOW, batch_size or 0)
+    while True:
+        entries, missed = [], []
+        for pmid, title, abstract in islice(documents, window):
+            key = cache_key(model, title, abstract)
+            cached = cache.get(key)
+            entries.append((pmid, key, cached))
+            if cached is None:
+                missed.append((pmid, title, abstract))
+        if not entries:
+            return
+        tokenized = iter(tokenize(missed, batch_size, n_process)) if missed else iter(())
+        for pmid, key, cached in entries:
+            if cached is not None:
+                yield pmid, cached[0], cached[1]
+                continue
+            _, title, abstract = next(tokenized)
+            title, abstract = clean_tokens(title), clean_tokens(abstract)
+            cache.put(key, title, abstract)
+            yield pmid, title, abstract
+
+def preprocess_documents(filepathIn, batch_size=None, n_process=1, skip=0, cache=None):
+    '''
+    Tokenizes and cleans the documents of a TREC or RELISH tsv file.
+
+    Parameters
+    ----------
+    filepathIn: str
+        The input file for the RELISH or TREC tsv to be transformed.
+    batch_size: int
+        If given, the texts are tokenized in batches of this size with nlp.pipe instead of one by one.
+    n_process: int
+        Number of processes used for the batched tokenization.
+    skip: int
+        Number of documents at the start of the file that are skipped.
+    cache: TokenCache
+        Optional cache of cleaned tokens, only documents missing from it are tokenized.
+    Returns
+    -------
+    documents: generator
+        Tuples of (pmid, cleaned title tokens, cleaned abstract tokens).
+    '''
+    documents = islice(read_documents(filepathIn), skip, None)
+    if cache is not None:
+        try:
+            yield from tokenize_cached(documents, cache, batch_size, n_process)
+        finally:
+            # Also logged if the documents are not consumed to the end.
+            logging.info(f"Token cache hits: {cache.hits}, misses: {cache.misses}.")
+        return
+    for pmid, title, abstract in tokenize(documents, batch_size, n_process):
+        yield pmid, clean_tokens(title), clean_tokens(abstract)
+
+def to_object_array(outputList):
+    '''
+    Converts documents into the (documents, 3) object array saved in the tokenized .npy files.
+
+    Parameters
+    ----------
+    outputList: list
+        Tuples of (pmid, title tokens, abstract tokens).
+    Returns
+    -------
+    output: np.ndarray
+        Object array where each row holds the pmid, title and abstract as numpy arrays.
+    '''
+    output = np.empty((len(outputList), 3), dtype=object)
+    for row, (pmid, title, abstract) in enumerate(outputList):
+        output[row, 0] = np.asanyarray(pmid)
+        output[row, 1] = np.asanyarray(title)
+        output[row, 2] = np.asanyarray(abstract)
+    return output
+
+def preprocessPhrases(filepathIn=None, filepathOut=None, batch_size=None, n_process=1, output_format="npy", cache=None):
     '''
     Transforms TREC and RELISH tsv file to lowercase and removes all special characters aside from the hyphen.
     Saves transformed TREC and RELISH files as an .npy format as a multi-dimensional array.
@@ -77,6 +468,16 @@ def preprocessPhrases(filepathIn=None, filepathOut=None):
     ----------
     filepathIn: str
         The input file for the RELISH or TREC tsv to be transformed.
+    filepathOut: str
+        The output .npy file.
+    batch_size: int
+        If given, the texts are tokenized in batches of this size with nlp.pipe instead of one by one.
+    n_process: int
+        Number of processes used for the batched tokenization.
+    output_format: str
+        "npy" saves a single .npy file, "corpus" saves a token id corpus directory (see token_corpus.py).
+    cache: TokenCache
+        Optional cache of cleaned tokens, only documents missing from it are tokenized.
     '''
     if not isinstance(filepathIn, str):
         logging.warn("Wrong parameter type for preprocessPhrases.")
@@ -85,35 +486,150 @@ def preprocessPhrases(filepathIn=None, filepathOut=None):
         logging.warn("Wrong parameter type for preprocessPhrases.")
         sys.exit("filepathOut needs to be of type string")
     else:
-        letters_pattern = '.*[a-zA-Z\d\-].*' #Includes all letters which are numbers, letters or a hyphen.
+        documents = preprocess_documents(filepathIn, batch_size, n_process, cache=cache)
+        if output_format == "corpus":
+            write_corpus(documents, filepathOut)
+        else:
+            np.save(filepathOut, to_object_array(list(documents)))
+
+def shard_directory(filepathOut):
+    '''
+    Returns the directory holding the shards and the checkpoint of a streaming run.
+    '''
+    return f"{os.path.splitext(filepathOut)[0]}_shards"
+
+def merge_shards(shardDirectory, filepathOut, output_format="npy"):
+    '''
+    Concatenates the shards of a streaming run into a single tokenized .npy file or a token id corpus.
+
+    Parameters
+    ----------
+    shardDirectory: str
+        Directory with the shard-*.npy files.
+    filepathOut: str
+        The output .npy file or corpus directory.
+    output_format: str
+        "npy" or "corpus" (see preprocessPhrases).
+    '''
+    shards = sorted(name for name in os.listdir(shardDirectory) if name.startswith("shard-") and name.endswith(".npy"))
+    if output_format == "corpus":
+        write_corpus((row for name in shards for row in np.load(os.path.join(shardDirectory, name), allow_pickle=True)),
+                     filepathOut)
+        return
+    arrays = [np.load(os.path.join(shardDirectory, name), allow_pickle=True) for name in shards]
+    np.save(filepathOut, np.concatenate(arrays) if arrays else np.empty((0, 3), dtype=object))
+
+def preprocessPhrasesStreaming(filepathIn=None, filepathOut=None, shard_size=1000, resume=False,
+                               batch_size=None, n_process=1, merge=True, cache=None, output_format="npy"):
+    '''
+    Streaming variant of preprocessPhrases. Documents are saved in shards of a fixed size as soon as they
+    are processed, and a checkpoint with the number of completed input rows is kept next to the shards,
+    so that an interrupted run can be resumed. At the end the shards are merged into the usual output.
+
+    Parameters
+    ----------
+    filepathIn: str
+        The input file for the RELISH or TREC tsv to be transformed.
+    filepathOut: str
+        The output .npy file or corpus directory. The shards are written to the directory "{filepathOut}_shards".
+    shard_size: int
+        Number of documents per shard.
+    resume: bool
+        Continue after the last checkpoint instead of starting over.
+    batch_size: int
+        If given, the texts are tokenized in batches of this size with nlp.pipe instead of one by one.
+    n_process: int
+        Number of processes used for the batched tokenization.
+    merge: bool
+        Merge the shards into filepathOut and remove them once all rows are processed.
+    cache: TokenCache
+        Optional cache of cleaned tokens, only documents missing from it are tokenized.
+    output_format: str
+        "npy" or "corpus" (see preprocessPhrases).
+    '''
+    if not isinstance(filepathIn, str):
+        logging.warn("Wrong parameter type for preprocessPhrasesStreaming.")
+        sys.exit("filepathIn needs to be of type string")
+    elif not isinstance(filepathOut, str):
+        logging.warn("Wrong parameter type for preprocessPhrasesStreaming.")
+        sys.exit("filepathOut needs to be of type string")
+    else:
+        shardDirectory = shard_directory(filepathOut)
+        checkpointPath = os.path.join(shardDirectory, "checkpoint.json")
+        checkpoint = {"rows": 0, "shards": 0}
+        if resume and os.path.exists(checkpointPath):
+            with open(checkpointPath) as file:
+                checkpoint = json.load(file)
+            logging.info(f"Resuming after row {checkpoint['rows']} ({checkpoint['shards']} shards).")
+        elif os.path.exists(shardDirectory):
+            shutil.rmtree(shardDirectory)
+        os.makedirs(shardDirectory, exist_ok=True)
+
+        def flush(outputList):
+            np.save(os.path.join(shardDirectory, f"shard-{checkpoint['shards']:06d}.npy"), to_object_array(outputList))
+            checkpoint["rows"] += len(outputList)
+            checkpoint["shards"] += 1
+            with open(checkpointPath + ".tmp", "w") as file:
+                json.dump(checkpoint, file)
+            os.replace(checkpointPath + ".tmp", checkpointPath)
+            logging.info(f"Saved shard {checkpoint['shards']}, {checkpoint['rows']} rows completed.")
+
         outputList = []
-        with open(filepathIn) as input:
-            inputFile = csv.reader(input, delimiter="\t")
-            headerline = True
-            for line in inputFile:
-                if(headerline):
-                        headerline = False
-                else:
-                    title = get_tokens(line[1].lower())
-                    abstract = get_tokens(line[2].lower())
-                    iteration = 0
-                    while(iteration < len(title)):
-                        word = "".join([c for c in str(title[iteration]) if re.match(letters_pattern, c)])
-                        title[iteration] = word
-                        iteration += 1
-                    iteration = 0
-                    while(iteration < len(abstract)):
-                        word = "".join([c for c in str(abstract[iteration]) if re.match(letters_pattern, c)])
-                        abstract[iteration] = word
-                        iteration += 1
-                    iteration = 0
-                    cleanedTitle = []
-                    for word in title:
-                        if word != "":
-                            cleanedTitle.append(word)
-                    cleanedAbstract = []
-                    for word in abstract:
-                        if word != "":
-                            cleanedAbstract.append(word)
-                    outputList.append([np.asanyarray(line[0]), np.asanyarray(cleanedTitle), np.asanyarray(cleanedAbstract)])
-            np.save(filepathOut, np.asanyarray(outputList))
\ No newline at end of file
+        for document in preprocess_documents(filepathIn, batch_size, n_process, checkpoint["rows"], cache):
+            outputList.append(document)
+            if len(outputList) == shard_size:
+                flush(outputList)
+                outputList = []
+        if outputList:
+            flush(outputList)
+
+        if merge:
+            merge_shards(shardDirectory, filepathOut, output_format)
+            shutil.rmtree(shardDirectory)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--input", type=str,
+                        help="Path to input RELISH or TREC TSV file")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Path to output tokenized NPY file or token id corpus directory")
+    parser.add_argument("--format", type=str, default="npy", choices=["npy", "corpus"],
+                        help="Output format: a single NPY file or a token id corpus directory")
+    parser.add_argument("--batch_size", type=int, default=None,
+                        help="Tokenize the texts in batches of this size with nlp.pipe")
+    parser.add_argument("--n_process", type=int, default=1,
+                        help="Number of processes for the batched tokenization, -1 uses all cores")
+    parser.add_argument("--shard_size", type=int, default=None,
+                        help="Stream the output in shards of this many documents with checkpoints")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume a streaming run from its last checkpoint")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Path to a token cache file, only documents missing from it are tokenized")
+    parser.add_argument("--cache_size", type=int, default=1024,
+                        help="Maximum size of the token cache in MB")
+    parser.add_argument("--server", type=str, default=DEFAULT_SERVER_ADDRESS,
+                        help="Address (Unix socket path or host:port) of a running tokenization server to use")
+    parser.add_argument("--no_server", action="store_true",
+                        help="Always load the model in-process")
+    parser.add_argument("--registry", type=str, default=None,
+                        help="Path to a PMID registry the tokenized PMIDs are recorded in")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if not args.no_server:
+        connect_server(args.server)
+
+    cache = TokenCache(args.cache, args.cache_size << 20) if args.cache else None
+    try:
+        if args.shard_size or args.resume:
+            preprocessPhrasesStreaming(args.input, args.output, args.shard_size or 1000, args.resume,
+                                       args.batch_size, args.n_process, cache=cache, output_format=args.format)
+        else:
+            preprocessPhrases(args.input, args.output, args.batch_size, args.n_process, args.format, cache)
+        if args.registry:
+            with PMIDRegistry(args.registry) as registry:
+                registry.update(TOKENIZATION, read_pmids(args.input), TOKENIZED)
+    finally:
+        if cache is not None:
+            cache.close()
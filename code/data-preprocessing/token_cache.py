@@ -0,0 +1,152 @@
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+
+"""
+Persistent cache of cleaned title and abstract tokens.
+
+Entries are keyed by a hash of the tokenizer model (name and version) and the
+normalized title and abstract, so that re-running the preprocessing on an
+updated TSV file only tokenizes new or changed documents. The cache is a single
+SQLite file; once it grows over its size limit, the least recently used entries
+are evicted.
+"""
+
+COMMIT_INTERVAL = 1000
+
+
+def cache_key(model: str, title: str, abstract: str) -> str:
+    """
+    Computes the cache key of a document.
+
+    Parameters
+    ----------
+    model: str
+        Name and version of the tokenizer model, i.e. "en_core_sci_lg-0.5.0".
+    title: str
+        Normalized (lowercase) title.
+    abstract: str
+        Normalized (lowercase) abstract.
+
+    Returns
+    -------
+    str:
+        Hex digest identifying the document for the given model.
+    """
+    digest = hashlib.sha256()
+    for part in (model, title, abstract):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class TokenCache:
+    """
+    On-disk key-value store of cleaned token lists with size-based eviction.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the SQLite cache file, created if it does not exist.
+    max_size: int
+        Maximum total size of the stored values in bytes.
+    """
+
+    def __init__(self, filepath: str, max_size: int = 1 << 30):
+        self.filepath = filepath
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS tokens (
+                                       key TEXT PRIMARY KEY,
+                                       value BLOB NOT NULL,
+                                       size INTEGER NOT NULL,
+                                       accessed REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS tokens_accessed ON tokens (accessed)")
+        # Total size of the stored values, kept up to date by put and evict instead of summing the table.
+        self._size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM tokens").fetchone()[0]
+
+    def get(self, key: str):
+        """
+        Looks up a document and counts the hit or miss.
+
+        Returns
+        -------
+        tokens: tuple or None
+            (title tokens, abstract tokens) if the document is cached.
+        """
+        row = self.connection.execute("SELECT value FROM tokens WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE tokens SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._count_change()
+        title, abstract = json.loads(zlib.decompress(row[0]))
+        return title, abstract
+
+    def put(self, key: str, title: list, abstract: list) -> None:
+        """
+        Stores the cleaned tokens of a document.
+        """
+        value = zlib.compress(json.dumps([title, abstract], separators=(",", ":")).encode("utf-8"), 1)
+        replaced = self.connection.execute("SELECT size FROM tokens WHERE key = ?", (key,)).fetchone()
+        self._size += len(value) - (replaced[0] if replaced is not None else 0)
+        self.connection.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+                                (key, value, len(value), time.time()))
+        self._count_change()
+
+    def _count_change(self) -> None:
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.evict()
+            self.connection.commit()
+            self._pending = 0
+
+    def size(self) -> int:
+        """
+        Returns the total size of the stored values in bytes.
+        """
+        return self._size
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used entries until the cache fits into max_size.
+
+        Returns
+        -------
+        int:
+            Number of evicted entries.
+        """
+        excess = self._size - self.max_size
+        if excess <= 0:
+            return 0
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM tokens ORDER BY accessed"):
+            evicted.append((key,))
+            excess -= size
+            self._size -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM tokens WHERE key = ?", evicted)
+        logging.info(f"Evicted {len(evicted)} entries from the token cache.")
+        return len(evicted)
+
+    def close(self) -> None:
+        """
+        Evicts entries over the size limit, commits and closes the cache.
+        """
+        self.evict()
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,302 @@
+import os
+import shutil
+import logging
+import argparse
+from array import array
+
+import numpy as np
+
+"""
+Token id corpus format for the tokenized RELISH and TREC documents.
+
+A corpus is a directory holding:
+
+    vocab.txt             one token per line, the line number is the token id
+    pmids.npy             uint32[documents]       PMID of every document, in input order
+    pmid_index.npy        uint32[documents]       sorted PMIDs
+    pmid_rows.npy         int32[documents]        document row of every entry in pmid_index
+    title_ids.npy         int32[title tokens]     token ids of all titles
+    title_offsets.npy     int64[documents + 1]    title of row i is title_ids[offsets[i]:offsets[i + 1]]
+    abstract_ids.npy      int32[abstract tokens]
+    abstract_offsets.npy  int64[documents + 1]
+
+All arrays are plain .npy files that are memory-mapped when read, so opening a
+corpus is instant and its pages are shared between worker processes.
+"""
+
+VOCAB_FILE = "vocab.txt"
+FIELDS = ("title", "abstract")
+
+
+def read_vocab(directory: str) -> list:
+    """
+    Reads the vocabulary of a corpus.
+
+    Parameters
+    ----------
+    directory: str
+        Path to the corpus directory.
+
+    Returns
+    -------
+    vocab: list
+        List of tokens, indexed by token id.
+    """
+    with open(os.path.join(directory, VOCAB_FILE), encoding="utf-8") as file:
+        return file.read().split("\n")[:-1]
+
+
+class CorpusWriter:
+    """
+    Writes documents into a token id corpus. Token ids are assigned in order of
+    first appearance and kept as compact int32 buffers until the corpus is closed.
+
+    Parameters
+    ----------
+    directory: str
+        Path to the output corpus directory.
+    vocab: list
+        Optional vocabulary to start from, i.e. the one of an existing corpus.
+    """
+
+    def __init__(self, directory: str, vocab: list = None):
+        self.directory = directory
+        self.vocab = list(vocab) if vocab else []
+        self.token_ids = {token: token_id for token_id, token in enumerate(self.vocab)}
+        self.pmids = array("I")
+        self.ids = {field: array("i") for field in FIELDS}
+        self.offsets = {field: array("q", [0]) for field in FIELDS}
+
+    def encode(self, tokens: list) -> list:
+        """
+        Converts tokens into token ids, extending the vocabulary with new tokens.
+        """
+        ids = []
+        for token in tokens:
+            token = str(token)
+            token_id = self.token_ids.get(token)
+            if token_id is None:
+                if "\n" in token:
+                    raise ValueError(f"Token {token!r} contains a line break.")
+                token_id = self.token_ids[token] = len(self.vocab)
+                self.vocab.append(token)
+            ids.append(token_id)
+        return ids
+
+    def add(self, pmid, title: list, abstract: list) -> None:
+        """
+        Appends a document to the corpus.
+
+        Parameters
+        ----------
+        pmid: int or str
+            PMID of the document.
+        title: list
+            Title tokens.
+        abstract: list
+            Abstract tokens.
+        """
+        self.pmids.append(int(pmid))
+        for field, tokens in zip(FIELDS, (title, abstract)):
+            self.add_ids(field, self.encode(tokens))
+
+    def add_ids(self, field: str, ids) -> None:
+        """
+        Appends the already encoded title or abstract of the next document.
+        """
+        self.ids[field].extend(ids)
+        self.offsets[field].append(len(self.ids[field]))
+
+    def close(self) -> None:
+        """
+        Writes the vocabulary and all arrays of the corpus to disk.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, VOCAB_FILE), "w", encoding="utf-8") as file:
+            file.writelines(f"{token}\n" for token in self.vocab)
+        pmids = np.frombuffer(self.pmids, dtype=np.uint32) if self.pmids else np.empty(0, dtype=np.uint32)
+        order = np.argsort(pmids, kind="stable")
+        np.save(os.path.join(self.directory, "pmids.npy"), pmids)
+        np.save(os.path.join(self.directory, "pmid_index.npy"), pmids[order])
+        np.save(os.path.join(self.directory, "pmid_rows.npy"), order.astype(np.int32))
+        for field in FIELDS:
+            ids = self.ids[field]
+            np.save(os.path.join(self.directory, f"{field}_ids.npy"),
+                    np.frombuffer(ids, dtype=np.int32) if ids else np.empty(0, dtype=np.int32))
+            np.save(os.path.join(self.directory, f"{field}_offsets.npy"),
+                    np.frombuffer(self.offsets[field], dtype=np.int64))
+        logging.info(f"Saved {len(pmids)} documents and {len(self.vocab)} tokens to {self.directory}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class TokenCorpus:
+    """
+    Read-only, memory-mapped token id corpus with random access by PMID.
+
+    Parameters
+    ----------
+    directory: str
+        Path to the corpus directory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._vocab = None
+        self.pmids = self._load("pmids")
+        self.pmid_index = self._load("pmid_index")
+        self.pmid_rows = self._load("pmid_rows")
+        self.ids = {field: self._load(f"{field}_ids") for field in FIELDS}
+        self.offsets = {field: self._load(f"{field}_offsets") for field in FIELDS}
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r")
+
+    @property
+    def vocab(self) -> list:
+        if self._vocab is None:
+            self._vocab = read_vocab(self.directory)
+        return self._vocab
+
+    def __len__(self) -> int:
+        return len(self.pmids)
+
+    def row(self, pmid) -> int:
+        """
+        Returns the row of a PMID, or -1 if it is not part of the corpus.
+        """
+        pmid = int(pmid)
+        index = np.searchsorted(self.pmid_index, pmid)
+        if index == len(self.pmid_index) or self.pmid_index[index] != pmid:
+            return -1
+        return int(self.pmid_rows[index])
+
+    def rows(self, pmids) -> np.ndarray:
+        """
+        Vectorized version of row for an array of PMIDs.
+        """
+        pmids = np.asarray(pmids, dtype=np.int64)
+        if not len(self.pmid_index):
+            return np.full(len(pmids), -1, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.pmid_index, pmids), len(self.pmid_index) - 1)
+        return np.where(self.pmid_index[index] == pmids, self.pmid_rows[index], -1)
+
+    def __contains__(self, pmid) -> bool:
+        return self.row(pmid) >= 0
+
+    def field_ids(self, field: str, row: int) -> np.ndarray:
+        """
+        Returns the token ids of the title or abstract of a row as a view on the corpus.
+        """
+        offsets = self.offsets[field]
+        return self.ids[field][offsets[row]:offsets[row + 1]]
+
+    def document(self, row: int):
+        """
+        Returns the document of a row in the same layout as the rows of the
+        tokenized .npy files.
+
+        Returns
+        -------
+        document: tuple
+            (pmid, title tokens, abstract tokens).
+        """
+        vocab = self.vocab
+        return (str(self.pmids[row]),
+                [vocab[token_id] for token_id in self.field_ids("title", row)],
+                [vocab[token_id] for token_id in self.field_ids("abstract", row)])
+
+    def get(self, pmid):
+        """
+        Returns the document of a PMID, or None if it is not part of the corpus.
+        """
+        row = self.row(pmid)
+        return self.document(row) if row >= 0 else None
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.document(row)
+
+    def subset(self, rows, directory: str) -> "TokenCorpus":
+        """
+        Writes the given rows into a new corpus sharing the same vocabulary.
+
+        Parameters
+        ----------
+        rows: array-like
+            Rows to keep, in output order.
+        directory: str
+            Path to the output corpus directory.
+
+        Returns
+        -------
+        TokenCorpus:
+            The new corpus.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        os.makedirs(directory, exist_ok=True)
+        shutil.copyfile(os.path.join(self.directory, VOCAB_FILE), os.path.join(directory, VOCAB_FILE))
+        pmids = np.asarray(self.pmids[rows], dtype=np.uint32)
+        order = np.argsort(pmids, kind="stable")
+        np.save(os.path.join(directory, "pmids.npy"), pmids)
+        np.save(os.path.join(directory, "pmid_index.npy"), pmids[order])
+        np.save(os.path.join(directory, "pmid_rows.npy"), order.astype(np.int32))
+        for field in FIELDS:
+            offsets = self.offsets[field]
+            starts = np.asarray(offsets[rows])
+            lengths = np.asarray(offsets[rows + 1]) - starts
+            new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=new_offsets[1:])
+            # Position of every kept token in the source array.
+            positions = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - starts, lengths)
+            np.save(os.path.join(directory, f"{field}_ids.npy"), np.asarray(self.ids[field][positions]))
+            np.save(os.path.join(directory, f"{field}_offsets.npy"), new_offsets)
+        return TokenCorpus(directory)
+
+
+def write_corpus(documents, directory: str) -> None:
+    """
+    Writes documents into a token id corpus.
+
+    Parameters
+    ----------
+    documents: iterable
+        Rows of (pmid, title tokens, abstract tokens), like the rows of the
+        tokenized .npy files.
+    directory: str
+        Path to the output corpus directory.
+    """
+    with CorpusWriter(directory) as writer:
+        for pmid, title, abstract in documents:
+            writer.add(pmid, title, abstract)
+
+
+def convert_npy(filepath_in: str, directory: str) -> None:
+    """
+    Converts a tokenized .npy file into a token id corpus.
+
+    Parameters
+    ----------
+    filepath_in: str
+        The filepath of the tokenized input npy file.
+    directory: str
+        Path to the output corpus directory.
+    """
+    write_corpus(np.load(filepath_in, allow_pickle=True), directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--input", type=str,
+                        help="Path to input tokenized NPY file")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Path to output token id corpus directory")
+    args = parser.parse_args()
+
+    convert_npy(args.input, args.output)
@@ -0,0 +1,145 @@
+import os
+import json
+import stat
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+
+import preprocessing
+
+"""
+Long-lived tokenization server that loads the ScispaCy model once and serves
+the get_tokens behaviour of preprocessing.py to any number of clients.
+
+Every request is a single line of JSON, {"method": ..., "texts": [...]}, and is
+answered with a single line of JSON, {"result": ...} or {"error": ...}:
+
+    tokens  list of get_tokens tokens (as strings) for every text
+    clean   list of cleaned tokens for every text, as in the preprocessPhrases output
+    model   name and version of the loaded model
+
+Start it with "python tokenization_server.py" and preprocessing.py uses it
+automatically instead of loading the model itself.
+"""
+
+
+class TokenizationHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the requests of one client connection until it is closed.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                result = self.server.process(request["method"], request.get("texts", []))
+                response = {"result": result}
+            except Exception as error:
+                logging.error("Could not process tokenization request.", exc_info=True)
+                response = {"error": str(error)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class TokenizationServerMixin:
+    """
+    Runs the requests of all connections on the single in-process model.
+    """
+    daemon_threads = True
+    batch_size = 256
+
+    def process(self, method, texts):
+        if method == "model":
+            return preprocessing.loaded_model_name()
+        elif method not in ("tokens", "clean"):
+            raise ValueError(f"Unknown method {method!r}.")
+        with self.lock:
+            tokens = preprocessing.tokenize_texts(texts, self.batch_size)
+        if method == "clean":
+            tokens = [preprocessing.clean_tokens(text_tokens) for text_tokens in tokens]
+        return tokens
+
+
+class UnixTokenizationServer(TokenizationServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+class TCPTokenizationServer(TokenizationServerMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def remove_stale_socket(path: str) -> None:
+    """
+    Removes a Unix socket left behind by a server that is no longer running.
+
+    Raises
+    ------
+    FileExistsError:
+        If a server is still listening on the socket or the path is not a socket.
+    """
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise FileExistsError(f"{path} exists and is not a socket.")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+        except FileNotFoundError:
+            return
+    raise FileExistsError(f"A server is already listening on {path}.")
+
+
+def create_server(address: str, batch_size: int = 256) -> socketserver.BaseServer:
+    """
+    Loads the model and binds the server to the given address.
+
+    Parameters
+    ----------
+    address: str
+        Either a Unix socket path or host:port.
+    batch_size: int
+        Number of texts processed by spaCy per batch.
+
+    Returns
+    -------
+    socketserver.BaseServer:
+        The bound server, start it with serve_forever().
+    """
+    family, address = preprocessing.parse_address(address)
+    if family == socket.AF_UNIX:
+        remove_stale_socket(address)
+    preprocessing.load_model()
+    if family == socket.AF_INET:
+        server = TCPTokenizationServer(address, TokenizationHandler)
+    else:
+        server = UnixTokenizationServer(address, TokenizationHandler)
+    server.lock = threading.Lock()
+    server.batch_size = batch_size
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-a", "--address", type=str, default=preprocessing.DEFAULT_SERVER_ADDRESS,
+                        help="Unix socket path or host:port to listen on")
+    parser.add_argument("--batch_size", type=int, default=256,
+                        help="Number of texts processed by spaCy per batch")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    server = create_server(args.address, args.batch_size)
+    logging.info(f"Tokenization server with model {preprocessing.loaded_model_name()} listening on {args.address}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server, UnixTokenizationServer) and os.path.exists(args.address):
+            os.remove(args.address)
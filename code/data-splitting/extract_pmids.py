@@ -1,8 +1,16 @@
+import os
+import sys
 import pandas as pd
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data-preprocessing'))
+from token_corpus import TokenCorpus
 
-def extract_pmids(input_file: str):
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pmid-store'))
+from pmid_registry import PMIDRegistry, SPLIT
+
+
+def extract_pmids(input_file: str, registry: str = None):
         # Calculating unique PMIDs present in the Train Dataset
         train_df = pd.read_csv('train_split.tsv', sep='\t')
         pmid1_train_set = set(train_df['PMID1'])
@@ -20,6 +28,25 @@ def extract_pmids(input_file: str):
         # Checking whether all PMIDs are exclusive between the Train and the Test dataset
         print(len((unique_pmids_train).intersection(unique_pmids_test)))
 
+        # Token id corpus: select the rows of every split without decoding the documents
+        if os.path.isdir(input_file):
+                corpus = TokenCorpus(input_file)
+                pmids = np.asarray(corpus.pmids, dtype=np.int64)
+                in_train = np.isin(pmids, list(unique_pmids_train))
+                in_test = np.isin(pmids, list(unique_pmids_test)) & ~in_train
+                in_val = ~in_train & ~in_test
+                print(in_train.sum(), in_test.sum(), in_val.sum())
+
+                if registry:
+                        with PMIDRegistry(registry) as pmid_registry:
+                                pmid_registry.update(SPLIT, pmids, np.select([in_train, in_test], ['train', 'test'], 'val'))
+
+                # Saving all three corpora with the corresponding pmids, title and abstracts
+                corpus.subset(np.flatnonzero(in_train), 'relish_train_annotated_tokens_removed_stopwords')
+                corpus.subset(np.flatnonzero(in_test), 'relish_test_annotated_removed_stopwords')
+                corpus.subset(np.flatnonzero(in_val), 'relish_val_annotated_tokens_removed_stopwords')
+                return
+
         # Loading the RELISH tokens npy file
         text_file = np.load(input_file, allow_pickle=True)
 
@@ -36,6 +63,11 @@ def extract_pmids(input_file: str):
 
         print(len(data_train), len(data_test), len(data_val))
 
+        if registry:
+                with PMIDRegistry(registry) as pmid_registry:
+                        for split, data in (('train', data_train), ('test', data_test), ('val', data_val)):
+                                pmid_registry.update(SPLIT, [line[0] for line in data], split)
+
         # Saving all three npy files witht he corresponding pmids, title and abstracts
         np.save('relish_train_annotated_tokens_removed_stopwords.npy', data_train, allow_pickle=True)
         np.save('relish_test_annotated_removed_stopwords.npy', data_test, allow_pickle=True)
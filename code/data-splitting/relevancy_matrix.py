@@ -1,11 +1,16 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data-preprocessing'))
+from ground_truth import load_ground_truth
+
 """
 Data Splitting Algorithm
 
-This script reads a TSV file ('RELISH.tsv') containing pairs of articles with relevance scores. It identifies unique reference and assessed articles, 
+This script reads the RELISH ground truth ('RELISH.tsv', through its binary store 'RELISH.qrels') containing pairs of articles with relevance scores. It identifies unique reference and assessed articles, 
 filters the data based on their existence, and saves excluded pairs in 'valid.tsv'. The main loop iterates 1000 times, 
 splitting the data into training and testing sets with an 80/20 ratio. The best split is determined by minimizing the error from the target split percentage. 
 Results, including sizes and percentages, are reported, and the best train and test splits are saved in 'train_split.tsv' and 'test_split.tsv'.
@@ -21,8 +26,8 @@ Note:
 """
 
 
-# Load the RELISH relevance file
-df = pd.read_csv('data/input/RELISH.tsv', delimiter='\t', header=None, names=['PMID1', 'PMID2', 'Relevance'])
+# Load the RELISH relevance file (memory-mapped from its binary store next to the tsv)
+df = load_ground_truth('data/input/RELISH.tsv').to_dataframe(['PMID1', 'PMID2', 'Relevance'])
 print('Initial pairs in relevance matrix:', len(df))
 
 # Load RELISH Title and Abstract file
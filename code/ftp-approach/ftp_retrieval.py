@@ -1,24 +1,662 @@
+import io
 import os
+import re
 import csv
 import sys
+import gzip
+import json
+import queue
+import bisect
+import sqlite3
 import pathlib
 import logging
+import threading
+from contextlib import contextmanager
 from io import StringIO
 from html.parser import HTMLParser
+from multiprocessing import Pool
 import xml.etree.cElementTree as ET
 
-def structureDataset(pmidSet, inputDirectoryXML, outputDirectoryXML, outputFilepathTSV):
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pmid-store'))
+from sharded_store import ShardedStore
+
+#MLStripper and strip_tags taken from https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python/925630#925630
+class MLStripper(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.reset()
+        self.strict = False
+        self.convert_charrefs= True
+        self.text = StringIO()
+    def handle_data(self, d):
+        self.text.write(d)
+    def get_data(self):
+        return self.text.getvalue()
+    def strip(self, html):
+        '''
+        Strips the tags of another string, so one instance can be reused for all strings.
+        '''
+        self.reset()
+        self.text = StringIO()
+        self.feed(html)
+        return self.get_data()
+
+def strip_tags(html):
+    s = MLStripper()
+    s.feed(html)
+    return s.get_data()
+
+DECOMPRESSION_CHUNK_SIZE = 1 << 20
+DECOMPRESSION_QUEUE_SIZE = 16
+
+class _QueueReader(io.RawIOBase):
+    '''
+    Raw binary stream reading the chunks put into a queue by a decompressor thread.
+    An empty chunk marks the end of the stream, an exception is raised in the reading thread.
+    '''
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = chunks
+        self.chunk = memoryview(b'')
+        self.eof = False
+    def readable(self):
+        return True
+    def readinto(self, buffer):
+        while not self.chunk and not self.eof:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.eof = not chunk
+            self.chunk = memoryview(chunk)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+def _decompress(path, chunks, stop):
+    '''
+    Decompresses a gzip file into the bounded chunk queue until it is done or stopped.
+    '''
+    def put(chunk):
+        while not stop.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    try:
+        with gzip.open(path, 'rb') as f:
+            while True:
+                chunk = f.read(DECOMPRESSION_CHUNK_SIZE)
+                if not put(chunk) or not chunk:
+                    return
+    except Exception as error:
+        put(error)
+
+@contextmanager
+def _openBinary(path):
+    '''
+    Opens a baseline file as binary stream. Gzipped files ('.gz') are decompressed by a separate thread
+    which feeds the scanner through a bounded queue, so decompression and scanning overlap
+    and the decompressed file never touches the disk.
+    '''
+    if not str(path).endswith('.gz'):
+        with open(path, 'rb') as f:
+            yield f
+        return
+    chunks = queue.Queue(DECOMPRESSION_QUEUE_SIZE)
+    stop = threading.Event()
+    decompressor = threading.Thread(target=_decompress, args=(path, chunks, stop), daemon=True)
+    decompressor.start()
+    try:
+        yield io.BufferedReader(_QueueReader(chunks), DECOMPRESSION_CHUNK_SIZE)
+    finally:
+        stop.set()
+        decompressor.join()
+
+@contextmanager
+def _openBaselineFile(path):
+    '''
+    Opens a baseline file, plain ('.xml') or gzipped ('.xml.gz'), for reading its lines as text.
+    '''
+    with _openBinary(path) as f:
+        yield io.TextIOWrapper(f, encoding='UTF8')
+
+def _iterArticles(lines, pmidSet):
+    '''
+    Finds the articles whose pmid is part of the pmid set in the lines of a pubmed baseline file.
+
+    Input:  lines   ->  iterable: Lines of the baseline xml file.
+            pmidSet ->  set: A set of pubmed ids (as int).
+    Output: Yields (pmid, entry) for every matching article, where entry is the xml of the article.
+    '''
+    prevprevline = ''
+    prevline = ''
+    entry = []
+    found = False
+    for line in lines:
+        if line.startswith("      <PMID"):
+            value = int(line.partition('>')[2].partition('<')[0])
+            if(int(value) in pmidSet):
+                found = True
+                entry += [prevprevline, prevline, line]
+        elif found:
+            entry.append(line)
+            if "</PubmedArticle>" in line:
+                yield (int)(value), ''.join(entry)
+                prevprevline = ''
+                prevline = ''
+                entry = []
+                found = False
+        else:
+            prevprevline = prevline
+            prevline = line
+
+def _scanBaselineFile(path, pmidSet, outputDirectory):
+    '''
+    Copies the articles of one baseline file whose pmid is part of the pmid set to '{outputDirectory}/{pmid}.xml'.
+
+    Input:  path            ->  pathlib.Path: The baseline xml file, either plain or gzipped.
+            pmidSet         ->  set: A set of pubmed ids.
+            outputDirectory ->  string: The directory the xml files are written to.
+    Output: List of the written pmids in order of their first appearance.
+    '''
+    pmids = {}
+    with _openBaselineFile(path) as lines:
+        for pmid, entry in _iterArticles(lines, pmidSet):
+            with open(f'{outputDirectory}/{pmid}.xml', 'w', encoding='UTF8') as f:
+                f.write(entry)
+            pmids[pmid] = None
+    return list(pmids)
+
+_workerPmidSet = None
+
+def _initScanner(pmidSet):
+    '''
+    Pool initializer, ships the pmid set once to every worker process.
+    '''
+    global _workerPmidSet
+    _workerPmidSet = pmidSet
+
+def _scanBaselineFileWorker(task):
+    '''
+    Scans one baseline file in a worker process into its own part directory.
+
+    Input:  task -> tuple: (path, partDirectory).
+    Output: List of the written pmids.
+    '''
+    path, partDirectory = task
+    os.makedirs(partDirectory, exist_ok=True)
+    return _scanBaselineFile(path, _workerPmidSet, partDirectory)
+
+def _baselineFiles(inputDirectoryXML):
+    '''
+    Lists the baseline files of a directory in a fixed (sorted) order, so that articles
+    contained in several files are always taken from the last file.
+    '''
+    return sorted(path for path in pathlib.Path(inputDirectoryXML).iterdir() if path.is_file())
+
+def _indexBaselineFile(path):
+    '''
+    Records the byte range of every article of a baseline file, as it would be copied by the scanner.
+    Offsets of gzipped files refer to the decompressed stream.
+
+    Input:  path -> pathlib.Path: The baseline xml file, either plain or gzipped.
+    Output: Tuple (name, size, mtime, articles), where articles is a list of (pmid, start, end).
+    '''
+    stat = path.stat()
+    articles = {}
+    offset = 0
+    prevprevStart = None
+    prevStart = None
+    start = None
+    with _openBinary(path) as lines:
+        for line in lines:
+            if line.startswith(b"      <PMID"):
+                if start is None:
+                    start = next(position for position in (prevprevStart, prevStart, offset) if position is not None)
+                pmid = int(line.partition(b'>')[2].partition(b'<')[0])
+            elif start is not None:
+                if b"</PubmedArticle>" in line:
+                    articles[pmid] = (pmid, start, offset + len(line))
+                    prevprevStart = None
+                    prevStart = None
+                    start = None
+            else:
+                prevprevStart = prevStart
+                prevStart = offset
+            offset += len(line)
+    return path.name, stat.st_size, stat.st_mtime_ns, list(articles.values())
+
+def _connectIndex(indexFilepath):
+    connection = sqlite3.connect(indexFilepath)
+    connection.execute('''CREATE TABLE IF NOT EXISTS files (
+                              name TEXT PRIMARY KEY,
+                              size INTEGER NOT NULL,
+                              mtime INTEGER NOT NULL,
+                              min_pmid INTEGER,
+                              max_pmid INTEGER)''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS articles (
+                              file TEXT NOT NULL,
+                              pmid INTEGER NOT NULL,
+                              start INTEGER NOT NULL,
+                              end INTEGER NOT NULL,
+                              PRIMARY KEY (file, pmid)) WITHOUT ROWID''')
+    return connection
+
+def buildBaselineIndex(inputDirectoryXML, indexFilepath, processes=1):
+    '''
+    Creates or updates a persistent index mapping every pmid of the baseline files to its source file
+    and the byte range of its <PubmedArticle> block. Only files which are new or changed (size or
+    modification time) since the last build are scanned, entries of removed files are dropped.
+
+    Input:  inputDirectoryXML   ->  string: The directory in which the XML files retrieved from the FTP server are located.
+            indexFilepath       ->  string: The filepath of the SQLite index file, created if it does not exist.
+            processes           ->  int: Number of worker processes scanning changed files in parallel.
+    '''
+    connection = _connectIndex(indexFilepath)
+    paths = {path.name: path for path in _baselineFiles(inputDirectoryXML)}
+    indexed = {name: (size, mtime) for name, size, mtime in connection.execute("SELECT name, size, mtime FROM files")}
+    changed = []
+    for name, path in paths.items():
+        stat = path.stat()
+        if indexed.get(name) != (stat.st_size, stat.st_mtime_ns):
+            changed.append(path)
+    removed = [name for name in indexed if name not in paths]
+    for name in removed + [path.name for path in changed]:
+        connection.execute("DELETE FROM articles WHERE file = ?", (name,))
+        connection.execute("DELETE FROM files WHERE name = ?", (name,))
+    connection.commit()
+
+    if processes > 1:
+        pool = Pool(processes)
+        results = pool.imap(_indexBaselineFile, changed)
+    else:
+        pool = None
+        results = map(_indexBaselineFile, changed)
+    try:
+        for name, size, mtime, articles in results:
+            pmids = [pmid for pmid, _, _ in articles]
+            connection.executemany("INSERT INTO articles VALUES (?, ?, ?, ?)",
+                                   ((name, pmid, start, end) for pmid, start, end in articles))
+            connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                               (name, size, mtime, min(pmids, default=None), max(pmids, default=None)))
+            connection.commit()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        connection.close()
+    logging.info(f"Indexed {len(changed)} changed and removed {len(removed)} baseline files.")
+
+def _openSeekable(path):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def _iterIndexedArticles(pmidSet, inputDirectoryXML, indexFilepath):
+    '''
+    Reads the articles whose pmid is part of the pmid set by seeking to their byte ranges in the index.
+    Files whose pmid range contains no requested pmid are skipped. Like the scanner, articles contained
+    in several files are taken from the last file.
+
+    Output: Yields (pmid, entry) once for every pmid found in the index.
+    '''
+    requested = sorted(int(pmid) for pmid in pmidSet)
+    connection = _connectIndex(indexFilepath)
+    try:
+        connection.execute("CREATE TEMP TABLE requested (pmid INTEGER PRIMARY KEY)")
+        connection.executemany("INSERT OR IGNORE INTO requested VALUES (?)", ((pmid,) for pmid in requested))
+        written = set()
+        files = connection.execute("SELECT name, min_pmid, max_pmid FROM files WHERE min_pmid IS NOT NULL ORDER BY name DESC").fetchall()
+        for name, minPmid, maxPmid in files:
+            if bisect.bisect_left(requested, minPmid) == bisect.bisect_right(requested, maxPmid):
+                continue
+            ranges = connection.execute('''SELECT pmid, start, end FROM articles
+                                           WHERE file = ? AND pmid IN (SELECT pmid FROM requested)
+                                           ORDER BY start''', (name,)).fetchall()
+            ranges = [(pmid, start, end) for pmid, start, end in ranges if pmid not in written]
+            if not ranges:
+                continue
+            with _openSeekable(pathlib.Path(inputDirectoryXML) / name) as f:
+                for pmid, start, end in ranges:
+                    f.seek(start)
+                    entry = f.read(end - start).decode('UTF8')
+                    if '\r' in entry:
+                        entry = entry.replace('\r\n', '\n').replace('\r', '\n')
+                    written.add(pmid)
+                    yield pmid, entry
+    finally:
+        connection.close()
+
+def _lookupArticles(pmidSet, inputDirectoryXML, indexFilepath, outputDirectory):
+    '''
+    Copies the articles whose pmid is part of the pmid set to '{outputDirectory}/{pmid}.xml' using the index.
+    '''
+    for pmid, entry in _iterIndexedArticles(pmidSet, inputDirectoryXML, indexFilepath):
+        with open(f'{outputDirectory}/{pmid}.xml', 'w', encoding='UTF8') as output:
+            output.write(entry)
+
+def _parseArticle(lines):
+    '''
+    Extracts pmid, title and abstract (still containing HTML notations) from the lines of an article.
+
+    Input:  lines -> iterable: Lines of the xml of a single article.
+    Output: Tuple (pmid, title, abstract), elements are None if not found.
+    '''
+    pmid = None
+    title = None
+    abstract = None
+    for line in lines:
+        if line.startswith("      <PMID"):
+            pmid = line.partition('>')[2].partition('</PMID')[0]
+        elif line.startswith("        <ArticleTitle"):
+            title = line.partition('>')[2].partition('</ArticleTitle')[0]
+        elif line.startswith("          <AbstractText Label="):
+            category = line.partition('Label="')[2].partition('\"')[0]
+            abstractText = line.partition('>')[2].partition('</AbstractText')[0]
+            if(abstract == None):
+                abstract = f"{category}: {abstractText}"
+            else:
+                abstract += f" {category}: {abstractText}"
+        elif line.startswith("          <AbstractText>"):
+            if(abstract == None):
+                abstract = line.partition('>')[2].partition('</AbstractText')[0]
+            else:
+                abstract += line.partition('>')[2].partition('</AbstractText')[0]
+    return pmid, title, abstract
+
+def _formattedXML(pmid, title, abstract):
+    '''
+    Serializes the plaintext pmid, title and abstract of an article to the bytes of its Formatted xml file.
+    '''
+    collection = ET.Element("collection")
+    ET.SubElement(collection, "source").text = "PubMed"
+    ET.SubElement(collection, "key").text = "collection.key"
+    document = ET.SubElement(collection, "document")
+    ET.SubElement(document, "id").text = pmid
+    passageTitle = ET.SubElement(document, "passage")
+    ET.SubElement(passageTitle, "infon", key="type").text = "title"
+    ET.SubElement(passageTitle, "text").text = title
+    passageAbstract = ET.SubElement(document, "passage")
+    ET.SubElement(passageAbstract, "infon", key="type").text = "abstract"
+    ET.SubElement(passageAbstract, "text").text = abstract
+    tree = ET.ElementTree(collection)
+    output = io.BytesIO()
+    tree.write(output, encoding='UTF8')
+    return output.getvalue()
+
+def _writeFormattedXML(outputDirectoryXML, pmid, title, abstract):
+    '''
+    Writes the plaintext pmid, title and abstract of an article to '{outputDirectoryXML}/Formatted/{pmid}.xml'.
+    '''
+    with open(f'{outputDirectoryXML}/Formatted/{pmid}.xml', 'wb') as f:
+        f.write(_formattedXML(pmid, title, abstract))
+
+def _formatOriginal(outputDirectoryXML, path, stripper):
+    '''
+    Writes the Formatted xml file of an Original xml file.
+
+    Output: The tsv row [pmid, title, abstract], None if the article has no title or abstract.
+    '''
+    with open(path, encoding='UTF8') as lines:
+        pmid, title, abstract = _parseArticle(lines)
+    if(pmid != None and title != None and abstract != None):
+        title = stripper.strip(title)
+        abstract = stripper.strip(abstract)
+        _writeFormattedXML(outputDirectoryXML, pmid, title, abstract)
+        return [pmid,title,abstract]
+    return None
+
+def _writeOutputs(outputDirectoryXML, outputFilepathTSV):
+    '''
+    Creates the Formatted xml files and the tsv file from the Original xml files.
+    '''
+    header = ['PMID', 'title', 'abstract']
+    with open(outputFilepathTSV, 'w', encoding='UTF8') as output:
+        writer = csv.writer(output, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar=' ')
+        writer.writerow(header)
+        stripper = MLStripper()
+        for path in sorted(pathlib.Path(f'{outputDirectoryXML}/Original').iterdir()):
+            if path.is_file():
+                row = _formatOriginal(outputDirectoryXML, path, stripper)
+                if row is not None:
+                    writer.writerow(row)
+
+def _extractArticle(entry, stripper):
+    '''
+    Extracts the tsv row [pmid, title, abstract] of an article directly from its xml,
+    None if the article has no title or abstract.
+
+    Input:  entry       ->  string: The xml of a single article, as copied to the Original xml files.
+            stripper    ->  MLStripper: Reused to remove the HTML notations.
+    '''
+    pmid, title, abstract = _parseArticle(StringIO(entry))
+    if(pmid != None and title != None and abstract != None):
+        return [pmid, stripper.strip(title), stripper.strip(abstract)]
+    return None
+
+def _extractBaselineFileWorker(task):
+    '''
+    Extracts the matching articles of one baseline file in a worker process.
+
+    Input:  task -> tuple: (path, keepEntries).
+    Output: List of (pmid, entry, row), entry is None unless keepEntries is set.
+    '''
+    path, keepEntries = task
+    stripper = MLStripper()
+    with _openBaselineFile(path) as lines:
+        return [(pmid, entry if keepEntries else None, _extractArticle(entry, stripper))
+                for pmid, entry in _iterArticles(lines, _workerPmidSet)]
+
+def _writeFusedOutputs(articles, outputDirectoryXML, outputFilepathTSV, writeOriginal, store=False):
+    '''
+    Writes the Formatted xml files, the tsv file and optionally the Original xml files straight from the
+    extracted articles. Articles found again replace the earlier version, the tsv rows are written in the
+    same order as by _writeOutputs.
+
+    Input:  articles -> iterable: (pmid, entry, row) in the order the articles were found.
+            store    -> bool: Append the xml files to the sharded stores '{outputDirectoryXML}/Original.store'
+                              and '{outputDirectoryXML}/Formatted.store' instead of writing one file per pmid.
+    '''
+    originals = ShardedStore(f'{outputDirectoryXML}/Original.store') if store and writeOriginal else None
+    formatted = ShardedStore(f'{outputDirectoryXML}/Formatted.store') if store else None
+    rows = {}
+    for pmid, entry, row in articles:
+        if originals is not None:
+            originals.put(pmid, entry)
+        elif writeOriginal:
+            with open(f'{outputDirectoryXML}/Original/{pmid}.xml', 'w', encoding='UTF8') as f:
+                f.write(entry)
+        if row is not None:
+            if formatted is not None:
+                formatted.put(row[0], _formattedXML(*row))
+            else:
+                _writeFormattedXML(outputDirectoryXML, *row)
+            rows[pmid] = row
+        else:
+            previous = rows.pop(pmid, None)
+            if previous is not None and formatted is not None:
+                formatted.delete(previous[0])
+            elif previous is not None:
+                os.remove(f'{outputDirectoryXML}/Formatted/{previous[0]}.xml')
+    for sharded in (originals, formatted):
+        if sharded is not None:
+            sharded.close()
+    header = ['PMID', 'title', 'abstract']
+    with open(outputFilepathTSV, 'w', encoding='UTF8') as output:
+        writer = csv.writer(output, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar=' ')
+        writer.writerow(header)
+        for pmid in sorted(rows, key=lambda pmid: f'{pmid}.xml'):
+            writer.writerow(rows[pmid])
+
+def _iterFusedArticles(pmidSet, paths, inputDirectoryXML, processes, indexFilepath, writeOriginal):
+    '''
+    Finds the matching articles with the index, the process pool or a serial scan and extracts them on the fly.
+
+    Output: Yields (pmid, entry, row) in the order the articles were found.
+    '''
+    stripper = MLStripper()
+    if indexFilepath is not None:
+        for pmid, entry in _iterIndexedArticles(pmidSet, inputDirectoryXML, indexFilepath):
+            yield pmid, entry, _extractArticle(entry, stripper)
+    elif processes > 1:
+        tasks = [(path, writeOriginal) for path in paths]
+        with Pool(processes, initializer=_initScanner, initargs=(pmidSet,)) as pool:
+            for articles in pool.imap(_extractBaselineFileWorker, tasks):
+                yield from articles
+    else:
+        for path in paths:
+            with _openBaselineFile(path) as lines:
+                for pmid, entry in _iterArticles(lines, pmidSet):
+                    yield pmid, entry, _extractArticle(entry, stripper)
+
+DELETED_PMID_PATTERN = re.compile(r'<PMID[^>]*>\s*(\d+)\s*</PMID>')
+
+def _splitDeletions(lines, deleted):
+    '''
+    Passes the lines of an update file through, except for its <DeleteCitation> section
+    whose pmids are appended to the deleted list instead.
+    '''
+    inside = False
+    for line in lines:
+        if "<DeleteCitation>" in line:
+            inside = True
+        if inside:
+            deleted.extend(int(pmid) for pmid in DELETED_PMID_PATTERN.findall(line))
+            if "</DeleteCitation>" in line:
+                inside = False
+        else:
+            yield line
+
+def _scanUpdateFile(path, pmidSet, outputDirectory):
+    '''
+    Copies the articles of one update file whose pmid is part of the pmid set to '{outputDirectory}/{pmid}.xml'.
+
+    Output: Tuple (updated, deleted) of the written pmids and the pmids of the <DeleteCitation> section.
+    '''
+    updated = {}
+    deleted = []
+    with _openBaselineFile(path) as lines:
+        for pmid, entry in _iterArticles(_splitDeletions(lines, deleted), pmidSet):
+            with open(f'{outputDirectory}/{pmid}.xml', 'w', encoding='UTF8') as f:
+                f.write(entry)
+            updated[pmid] = None
+    return list(updated), deleted
+
+def _patchTSV(outputDirectoryXML, outputFilepathTSV, changed):
+    '''
+    Replaces the tsv rows of the changed pmids by the rows of their current Original xml files,
+    rows of pmids without Original xml file are removed. Rows are kept in the order of a full rebuild.
+    '''
+    rows = {}
+    header = 'PMID\ttitle\tabstract\r\n'
+    if os.path.exists(outputFilepathTSV):
+        with open(outputFilepathTSV, encoding='UTF8', newline='') as tsv:
+            header = next(tsv, header)
+            for line in tsv:
+                rows[line.partition('\t')[0]] = line
+    stripper = MLStripper()
+    for pmid in changed:
+        rows.pop(str(pmid), None)
+        path = pathlib.Path(f'{outputDirectoryXML}/Original/{pmid}.xml')
+        if path.is_file():
+            row = _formatOriginal(outputDirectoryXML, path, stripper)
+            if row is not None:
+                line = StringIO()
+                csv.writer(line, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar=' ').writerow(row)
+                rows[str(row[0])] = line.getvalue()
+    temporaryFilepath = f'{outputFilepathTSV}.tmp'
+    with open(temporaryFilepath, 'w', encoding='UTF8', newline='') as output:
+        output.write(header)
+        for pmid in sorted(rows, key=lambda pmid: f'{pmid}.xml'):
+            output.write(rows[pmid])
+    os.replace(temporaryFilepath, outputFilepathTSV)
+
+def applyUpdateFiles(pmidSet, updateDirectoryXML, outputDirectoryXML, outputFilepathTSV, stateFilepath=None):
+    '''
+    Applies the pubmed daily update files 'ftp.ncbi.nlm.nih.gov/pubmed/updatefiles' to the output of structureDataset.
+    Update files are applied in order of their names and skipped if they have been applied before, the newest version
+    of every pmid of the pmid set replaces the previous one and pmids listed in <DeleteCitation> are removed.
+    The Original and Formatted xml files of the affected pmids and their rows of the tsv file are patched in place.
+
+    Input:  pmidSet             ->  set: A set of pubmed ids.
+            updateDirectoryXML  ->  string: The directory in which the (gzipped) update files are located.
+            outputDirectoryXML  ->  string: The output directory of structureDataset.
+            outputFilepathTSV   ->  string: The tsv filepath of structureDataset.
+            stateFilepath       ->  string: JSON file listing the applied update files, defaults to '{outputDirectoryXML}/applied_updates.json'.
+    Output: List of the names of the newly applied update files.
+    '''
+    if not isinstance(pmidSet, set):
+        logging.alert("Wrong parameter type for applyUpdateFiles.")
+        sys.exit("pmidSet needs to be of type set")
+    stateFilepath = stateFilepath or f'{outputDirectoryXML}/applied_updates.json'
+    applied = []
+    if os.path.exists(stateFilepath):
+        with open(stateFilepath, encoding='UTF8') as state:
+            applied = json.load(state)
+    pending = [path for path in _baselineFiles(updateDirectoryXML) if path.name not in set(applied)]
+    if not pending:
+        return []
+
+    stagingDirectory = f'{outputDirectoryXML}/.update'
+    for directory in ('Original', 'Formatted'):
+        os.makedirs(f'{outputDirectoryXML}/{directory}', exist_ok=True)
+    os.makedirs(stagingDirectory, exist_ok=True)
+    changed = set()
+    for path in pending:
+        updated, deleted = _scanUpdateFile(path, pmidSet, stagingDirectory)
+        for pmid in updated:
+            os.replace(f'{stagingDirectory}/{pmid}.xml', f'{outputDirectoryXML}/Original/{pmid}.xml')
+        for pmid in deleted:
+            for directory in ('Original', 'Formatted'):
+                if os.path.exists(f'{outputDirectoryXML}/{directory}/{pmid}.xml'):
+                    os.remove(f'{outputDirectoryXML}/{directory}/{pmid}.xml')
+        changed.update(updated)
+        changed.update(deleted)
+        logging.info(f"Update file {path.name}: {len(updated)} updated and {len(deleted)} deleted citations.")
+    os.rmdir(stagingDirectory)
+
+    # Formatted files of updated articles without title or abstract are stale.
+    for pmid in changed:
+        if os.path.exists(f'{outputDirectoryXML}/Formatted/{pmid}.xml'):
+            os.remove(f'{outputDirectoryXML}/Formatted/{pmid}.xml')
+    _patchTSV(outputDirectoryXML, outputFilepathTSV, changed)
+
+    # The state is only written once the outputs are consistent, an interrupted run is simply repeated.
+    temporaryFilepath = f'{stateFilepath}.tmp'
+    with open(temporaryFilepath, 'w', encoding='UTF8') as state:
+        json.dump(applied + [path.name for path in pending], state, indent=1)
+    os.replace(temporaryFilepath, stateFilepath)
+    return [path.name for path in pending]
+
+def structureDataset(pmidSet, inputDirectoryXML, outputDirectoryXML, outputFilepathTSV, processes=1, indexFilepath=None, fused=False, writeOriginal=True, store=False):
     '''
     Takes metadata from the pubmed FTP data set 'ftp.ncbi.nlm.nih.gov/pubmed/baseline' which match with the given pmid from the pmid set,
     writes it onto an xml file as well as a tsv file containing the article's pmid, title and abstract.
-    
+
     Input:  pmidSet             ->  set: A set of pubmed ids.
             inputDirectoryXML   ->  string: The directory in which the XML files retrieved from the FTP server are located.
+                                            Gzipped files ('.xml.gz') are read directly without decompressing them first.
             outputDirectoryXML  ->  string: The output directory of the resulting individual xml files within two directories.
                                             Original: The original xml data copied directly from the FTP server
                                             Formatted: XML data only contains plaintext pmid, title and abstract where any HTML notations have been removed.
             outputFilepathTSV   ->  string: The output filepath of the resulting tsv file,
                                             results in a single tsv file containing all given pmids with their respective titles and abstracts.
+            processes           ->  int: Number of worker processes scanning the baseline files in parallel.
+                                         Every worker writes into its own part directory, the parts are merged in file order
+                                         so the result is identical to a serial run.
+            indexFilepath       ->  string: Optional filepath of a baseline index (see buildBaselineIndex). If given, the index is
+                                            brought up to date and the articles are read directly from their byte ranges
+                                            instead of scanning all baseline files.
+            fused               ->  bool: Extract pmid, title and abstract as soon as an article is found and write the tsv and
+                                          Formatted xml files in the same pass, instead of re-reading the Original xml files.
+                                          Only the articles found in this run are written to the tsv file.
+            writeOriginal       ->  bool: Whether the Original xml files are written in fused mode.
+            store               ->  bool: Append the Original and Formatted xml files to the sharded stores 'Original.store'
+                                          and 'Formatted.store' in outputDirectoryXML (see code/pmid-store) instead of writing
+                                          one file per pmid. Implies fused mode.
     '''
     if not isinstance(pmidSet, set):
         logging.alert("Wrong parameter type for structureDataset.")
@@ -33,105 +671,50 @@ def structureDataset(pmidSet, inputDirectoryXML, outputDirectoryXML, outputFilep
         logging.alert("Wrong parameter type for structureDataset.")
         sys.exit("outputDirectoryXML needs to be of type string")
     else:
-        #MLStripper and strip_tags taken from https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python/925630#925630
         try:
-            class MLStripper(HTMLParser):
-                def __init__(self):
-                    super().__init__()
-                    self.reset()
-                    self.strict = False
-                    self.convert_charrefs= True
-                    self.text = StringIO()
-                def handle_data(self, d):
-                    self.text.write(d)
-                def get_data(self):
-                    return self.text.getvalue()
-            def strip_tags(html):
-                s = MLStripper()
-                s.feed(html)
-                return s.get_data()
+            fused = fused or store
+            if not os.path.exists(f'{outputDirectoryXML}/Original') and not store:
+                os.makedirs(f'{outputDirectoryXML}/Original')
+            if not os.path.exists(f'{outputDirectoryXML}/Formatted') and not store:
+                os.makedirs(f'{outputDirectoryXML}/Formatted')
+            paths = _baselineFiles(inputDirectoryXML)
+            if indexFilepath is not None:
+                buildBaselineIndex(inputDirectoryXML, indexFilepath, processes)
         except:
-            logging.error("Couldn't strip HTML tags.")
+            logging.error("outputDirectoryXML is invalid.")
+            return None
+
+        if fused:
+            try:
+                articles = _iterFusedArticles(pmidSet, paths, inputDirectoryXML, processes, indexFilepath, writeOriginal)
+                _writeFusedOutputs(articles, outputDirectoryXML, outputFilepathTSV, writeOriginal, store)
+            except:
+                logging.error("Could not create tsv and xmls.")
+            return None
 
         try:
-            if not os.path.exists(f'{outputDirectoryXML}/Original'):
-                os.makedirs(f'{outputDirectoryXML}/Original')
-            if not os.path.exists(f'{outputDirectoryXML}/Formatted'):
-                os.makedirs(f'{outputDirectoryXML}/Formatted')
-            for path in pathlib.Path(inputDirectoryXML).iterdir():
-                if path.is_file():
-                    prevprevline = ''
-                    prevline = ''
-                    entry = ''
-                    found = False
-                    for line in open(path, encoding='UTF8'):
-                        if line.startswith("      <PMID"):
-                            value = int(line.partition('>')[2].partition('<')[0])
-                            if(int(value) in pmidSet):
-                                found = True
-                                entry += prevprevline
-                                entry += prevline
-                                entry += line
-                        elif found:
-                            entry += line
-                            if "</PubmedArticle>" in line:
-                                with open(f'{outputDirectoryXML}/Original/{(int)(value)}.xml', 'w', encoding='UTF8') as f:
-                                    f.write(entry)
-                                prevprevline = ''
-                                prevline = ''
-                                entry = ''
-                                found = False
-                        else:
-                            prevprevline = prevline
-                            prevline = line
+            if indexFilepath is not None:
+                _lookupArticles(pmidSet, inputDirectoryXML, indexFilepath, f'{outputDirectoryXML}/Original')
+            elif processes > 1:
+                partsDirectory = f'{outputDirectoryXML}/.parts'
+                tasks = [(path, f'{partsDirectory}/{path.name}') for path in paths]
+                with Pool(processes, initializer=_initScanner, initargs=(pmidSet,)) as pool:
+                    # Merge the part directories in baseline file order while the remaining files are scanned.
+                    for (path, partDirectory), pmids in zip(tasks, pool.imap(_scanBaselineFileWorker, tasks)):
+                        for pmid in pmids:
+                            os.replace(f'{partDirectory}/{pmid}.xml', f'{outputDirectoryXML}/Original/{pmid}.xml')
+                        os.rmdir(partDirectory)
+                if os.path.exists(partsDirectory):
+                    os.rmdir(partsDirectory)
+            else:
+                for path in paths:
+                    _scanBaselineFile(path, pmidSet, f'{outputDirectoryXML}/Original')
         except:
             logging.error("outputDirectoryXML is invalid.")
             return None
 
-        header = ['PMID', 'title', 'abstract']
         try:
-            with open(outputFilepathTSV, 'w', encoding='UTF8') as output:
-                writer = csv.writer(output, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar=' ')
-                writer.writerow(header)
-                for path in pathlib.Path(f'{outputDirectoryXML}/Original').iterdir():
-                    if path.is_file():
-                        pmid = None
-                        title = None
-                        abstract = None
-                        for line in open(path, encoding='UTF8'):
-                            if line.startswith("      <PMID"):
-                                pmid = line.partition('>')[2].partition('</PMID')[0]
-                            elif line.startswith("        <ArticleTitle"):
-                                title = line.partition('>')[2].partition('</ArticleTitle')[0]
-                            elif line.startswith("          <AbstractText Label="):
-                                category = line.partition('Label="')[2].partition('\"')[0]
-                                abstractText = line.partition('>')[2].partition('</AbstractText')[0]
-                                if(abstract == None):
-                                    abstract = f"{category}: {abstractText}"
-                                else:
-                                    abstract += f" {category}: {abstractText}"
-                            elif line.startswith("          <AbstractText>"):
-                                if(abstract == None):
-                                    abstract = line.partition('>')[2].partition('</AbstractText')[0]
-                                else:
-                                    abstract += line.partition('>')[2].partition('</AbstractText')[0]
-                        if(pmid != None and title != None and abstract != None):
-                            collection = ET.Element("collection")
-                            ET.SubElement(collection, "source").text = "PubMed"
-                            ET.SubElement(collection, "key").text = "collection.key"
-                            document = ET.SubElement(collection, "document")
-                            ET.SubElement(document, "id").text = pmid
-                            passageTitle = ET.SubElement(document, "passage")
-                            ET.SubElement(passageTitle, "infon", key="type").text = "title"
-                            title = strip_tags(title)
-                            abstract = strip_tags(abstract)
-                            ET.SubElement(passageTitle, "text").text = title
-                            passageAbstract = ET.SubElement(document, "passage")
-                            ET.SubElement(passageAbstract, "infon", key="type").text = "abstract"
-                            ET.SubElement(passageAbstract, "text").text = abstract
-                            tree = ET.ElementTree(collection)
-                            tree.write(f'{outputDirectoryXML}/Formatted/{pmid}.xml', encoding='UTF8')
-                            writer.writerow([pmid,title,abstract])
+            _writeOutputs(outputDirectoryXML, outputFilepathTSV)
         except:
             logging.error("Could not create tsv and xmls.")
-            return None
\ No newline at end of file
+            return None
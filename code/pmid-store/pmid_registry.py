@@ -0,0 +1,232 @@
+import time
+import sqlite3
+import argparse
+
+import pandas as pd
+
+"""
+Persistent registry of the pipeline status of every PMID.
+
+Every stage records the PMIDs it processed in bulk under its own name:
+
+    retrieval          retrieved, "No title or abstract", "No API entry" or "Request failed"
+    structure_words    cleaned
+    tokenization       tokenized
+    split              train, test or val
+
+so that a stage can ask the registry which PMIDs still need work instead of
+comparing the TSV outputs of earlier runs. PMIDs with a transient status, i.e.
+"Request failed", are recorded but still need work. The registry is a single
+SQLite file with one row per (pmid, stage); all queries over a list of PMIDs
+are joins against a temporary table instead of per-PMID lookups.
+"""
+
+RETRIEVAL = "retrieval"
+STRUCTURE_WORDS = "structure_words"
+TOKENIZATION = "tokenization"
+SPLIT = "split"
+STAGES = (RETRIEVAL, STRUCTURE_WORDS, TOKENIZATION, SPLIT)
+
+RETRIEVED = "retrieved"
+NO_TITLE_ABSTRACT = "No title or abstract"
+NO_API_ENTRY = "No API entry"
+REQUEST_FAILED = "Request failed"
+CLEANED = "cleaned"
+TOKENIZED = "tokenized"
+
+# Statuses of PMIDs which still need work, i.e. requests that failed and are retried by the next run.
+TRANSIENT = (REQUEST_FAILED,)
+
+
+class PMIDRegistry:
+    """
+    Status of every PMID per pipeline stage.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the SQLite registry file, created if it does not exist.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS status (
+                                       pmid INTEGER NOT NULL,
+                                       stage TEXT NOT NULL,
+                                       status TEXT NOT NULL,
+                                       updated REAL NOT NULL,
+                                       PRIMARY KEY (pmid, stage))""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS status_stage ON status (stage, status)")
+
+    def update(self, stage: str, pmids, status) -> int:
+        """
+        Records the status of a stage for many PMIDs in a single transaction,
+        replacing their earlier status of the stage.
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage, one of STAGES.
+        pmids: iterable
+            PMIDs as int or str.
+        status: str or iterable
+            A status for all PMIDs, or one status per PMID.
+
+        Returns
+        -------
+        int:
+            Number of recorded PMIDs.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage}, expected one of {STAGES}.")
+        pmids = [int(pmid) for pmid in pmids]
+        statuses = [status] * len(pmids) if isinstance(status, str) else [str(value) for value in status]
+        if len(statuses) != len(pmids):
+            raise ValueError("pmids and status need to be of the same length.")
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)",
+                                        ((pmid, stage, value, now) for pmid, value in zip(pmids, statuses)))
+        return len(pmids)
+
+    def _requested(self, pmids) -> None:
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS requested (pmid INTEGER PRIMARY KEY)")
+        self.connection.execute("DELETE FROM requested")
+        self.connection.executemany("INSERT OR IGNORE INTO requested VALUES (?)",
+                                    ((int(pmid),) for pmid in pmids))
+
+    def status(self, stage: str, pmids=None) -> pd.DataFrame:
+        """
+        Returns the status of a stage.
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage.
+        pmids: iterable
+            Optional PMIDs to restrict the result to, PMIDs without status of the stage are left out.
+
+        Returns
+        -------
+        pandas.DataFrame:
+            Columns PMID and status, sorted by PMID.
+        """
+        if pmids is None:
+            query = "SELECT pmid AS PMID, status FROM status WHERE stage = ? ORDER BY pmid"
+        else:
+            self._requested(pmids)
+            query = """SELECT status.pmid AS PMID, status.status FROM requested
+                       JOIN status ON status.pmid = requested.pmid AND status.stage = ? ORDER BY status.pmid"""
+        return pd.read_sql_query(query, self.connection, params=(stage,))
+
+    def pending(self, stage: str, pmids=None, requires: dict = None) -> list:
+        """
+        Returns the PMIDs which still need work in a stage.
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage.
+        pmids: iterable
+            PMIDs to check, by default all PMIDs of the registry.
+        requires: dict
+            Optional {stage: status} conditions on earlier stages, i.e. {"retrieval": "retrieved"},
+            PMIDs not fulfilling them are not pending.
+
+        Returns
+        -------
+        list:
+            Sorted PMIDs without status of the stage or with a TRANSIENT status.
+        """
+        if pmids is None:
+            source = "SELECT DISTINCT pmid FROM status"
+        else:
+            self._requested(pmids)
+            source = "SELECT pmid FROM requested"
+        query = f"""SELECT candidates.pmid FROM ({source}) AS candidates
+                    LEFT JOIN status AS done ON done.pmid = candidates.pmid AND done.stage = ?
+                    AND done.status NOT IN ({", ".join("?" * len(TRANSIENT))})"""
+        params = [stage, *TRANSIENT]
+        for i, (required_stage, required_status) in enumerate((requires or {}).items()):
+            query += f""" JOIN status AS required{i} ON required{i}.pmid = candidates.pmid
+                          AND required{i}.stage = ? AND required{i}.status = ?"""
+            params += [required_stage, required_status]
+        query += " WHERE done.pmid IS NULL ORDER BY candidates.pmid"
+        return [pmid for pmid, in self.connection.execute(query, params)]
+
+    def table(self) -> pd.DataFrame:
+        """
+        Returns the status of all PMIDs with one column per stage.
+        """
+        data = pd.read_sql_query("SELECT pmid AS PMID, stage, status FROM status", self.connection)
+        table = data.pivot(index="PMID", columns="stage", values="status")
+        return table.reindex(columns=[stage for stage in STAGES if stage in table.columns]).reset_index()
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Returns the number of PMIDs per stage and status.
+        """
+        return pd.read_sql_query("""SELECT stage, status, COUNT(*) AS PMIDs FROM status
+                                    GROUP BY stage, status ORDER BY stage, status""", self.connection)
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def missing_reasons(pmids, retrieved, skipped, failed=()) -> pd.DataFrame:
+    """
+    Reconciles a list of requested PMIDs with the retrieval results.
+
+    Parameters
+    ----------
+    pmids: iterable
+        Requested PMIDs.
+    retrieved: iterable
+        PMIDs with title and abstract.
+    skipped: iterable
+        PMIDs whose document misses the title or the abstract.
+    failed: iterable
+        PMIDs whose request failed, they are reported as REQUEST_FAILED instead of NO_API_ENTRY.
+
+    Returns
+    -------
+    pandas.DataFrame:
+        Columns PMID and Reason of every requested PMID that was not retrieved, in request order.
+    """
+    requested = pd.Series(pmids, dtype=object).astype(str)
+    missing = requested[~requested.isin(pd.Series(retrieved, dtype=object).astype(str))]
+    reason = missing.isin(pd.Series(skipped, dtype=object).astype(str)).map({True: NO_TITLE_ABSTRACT, False: NO_API_ENTRY})
+    reason[(reason == NO_API_ENTRY) & missing.isin(pd.Series(failed, dtype=object).astype(str))] = REQUEST_FAILED
+    return pd.DataFrame({"PMID": missing.to_numpy(), "Reason": reason.to_numpy()})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-r", "--registry", type=str, required=True,
+                        help="Path to the registry file")
+    parser.add_argument("--pending", type=str, choices=STAGES,
+                        help="Print the PMIDs which still need work in this stage")
+    parser.add_argument("--requires", type=str, nargs="*", default=[],
+                        help="Conditions stage=status on earlier stages for --pending")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Path to an output TSV file of the complete status table")
+    args = parser.parse_args()
+
+    with PMIDRegistry(args.registry) as registry:
+        if args.pending:
+            requires = dict(condition.split("=", 1) for condition in args.requires)
+            for pmid in registry.pending(args.pending, requires=requires):
+                print(pmid)
+        elif args.output:
+            registry.table().to_csv(args.output, sep="\t", index=False)
+        else:
+            print(registry.summary().to_string(index=False))
@@ -0,0 +1,274 @@
+import os
+import sqlite3
+import logging
+import argparse
+
+"""
+Sharded, append-only container for per-PMID documents (i.e. the Original and
+Formatted xml files of ftp_retrieval.py or the pmid-xml files of the BioC approach).
+
+A store is a directory holding:
+
+    index.sqlite      pmid -> (shard, offset, length) of the latest version of every document
+    shard-0000.dat    concatenated documents of all pmids with pmid % shards == 0
+    ...
+
+Documents are only ever appended to their shard, so millions of documents take
+a fixed number of files instead of one file each. Replacing a document appends
+the new version and points the index to it; the old bytes stay in the shard
+until the store is compacted.
+"""
+
+INDEX_FILE = "index.sqlite"
+SHARD_FILE = "shard-{:04d}.dat"
+COMMIT_INTERVAL = 1000
+
+
+def is_store(directory: str) -> bool:
+    """
+    Checks whether a directory is a sharded store.
+    """
+    return os.path.isfile(os.path.join(directory, INDEX_FILE))
+
+
+class ShardedStore:
+    """
+    Key-value store of documents by PMID with random access through the index.
+
+    Parameters
+    ----------
+    directory: str
+        Path to the store directory, created if it does not exist.
+    shards: int
+        Number of shard files of a new store. Existing stores keep the number they were created with.
+    readonly: bool
+        Open an existing store for reading only.
+    """
+
+    def __init__(self, directory: str, shards: int = 64, readonly: bool = False):
+        if readonly and not is_store(directory):
+            raise FileNotFoundError(f"{directory} is not a sharded store.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.readonly = readonly
+        self._pending = 0
+        self._writers = {}
+        self._readers = {}
+        self.connection = sqlite3.connect(os.path.join(directory, INDEX_FILE))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS documents (
+                                       pmid INTEGER PRIMARY KEY,
+                                       shard INTEGER NOT NULL,
+                                       offset INTEGER NOT NULL,
+                                       length INTEGER NOT NULL)""")
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'shards'").fetchone()
+        if row is None:
+            self.connection.execute("INSERT INTO meta VALUES ('shards', ?)", (shards,))
+            self.connection.commit()
+            row = (shards,)
+        self.shards = row[0]
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.directory, SHARD_FILE.format(shard))
+
+    def _writer(self, shard: int):
+        if self.readonly:
+            raise PermissionError(f"{self.directory} is opened read-only.")
+        if shard not in self._writers:
+            self._writers[shard] = open(self._shard_path(shard), "ab")
+        return self._writers[shard]
+
+    def _reader(self, shard: int):
+        if shard in self._writers:
+            self._writers[shard].flush()
+        if shard not in self._readers:
+            self._readers[shard] = open(self._shard_path(shard), "rb")
+        return self._readers[shard]
+
+    def put(self, pmid, document) -> None:
+        """
+        Appends a document, replacing any earlier version of the PMID.
+
+        Parameters
+        ----------
+        pmid: int or str
+            PMID of the document.
+        document: bytes or str
+            The document, strings are stored UTF-8 encoded.
+        """
+        pmid = int(pmid)
+        if isinstance(document, str):
+            document = document.encode("utf-8")
+        shard = pmid % self.shards
+        writer = self._writer(shard)
+        offset = writer.tell()
+        writer.write(document)
+        self.connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                                (pmid, shard, offset, len(document)))
+        self._count_change()
+
+    def delete(self, pmid) -> bool:
+        """
+        Removes a PMID from the index.
+
+        Returns
+        -------
+        bool:
+            Whether the PMID was part of the store.
+        """
+        cursor = self.connection.execute("DELETE FROM documents WHERE pmid = ?", (int(pmid),))
+        self._count_change()
+        return cursor.rowcount > 0
+
+    def _count_change(self) -> None:
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the appended documents to disk before committing the index entries pointing to them.
+        """
+        for writer in self._writers.values():
+            writer.flush()
+        self.connection.commit()
+        self._pending = 0
+
+    def get(self, pmid):
+        """
+        Returns the document of a PMID as bytes, or None if it is not part of the store.
+        """
+        row = self.connection.execute("SELECT shard, offset, length FROM documents WHERE pmid = ?",
+                                      (int(pmid),)).fetchone()
+        if row is None:
+            return None
+        shard, offset, length = row
+        reader = self._reader(shard)
+        reader.seek(offset)
+        return reader.read(length)
+
+    def __contains__(self, pmid) -> bool:
+        return self.connection.execute("SELECT 1 FROM documents WHERE pmid = ?", (int(pmid),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def keys(self) -> list:
+        """
+        Returns the sorted PMIDs of the store.
+        """
+        return [pmid for pmid, in self.connection.execute("SELECT pmid FROM documents ORDER BY pmid")]
+
+    def items(self):
+        """
+        Iterates over all documents in storage order, so every shard is read sequentially.
+
+        Returns
+        -------
+        Generator of (pmid, document bytes).
+        """
+        rows = self.connection.execute("SELECT pmid, shard, offset, length FROM documents ORDER BY shard, offset").fetchall()
+        for pmid, shard, offset, length in rows:
+            reader = self._reader(shard)
+            if reader.tell() != offset:
+                reader.seek(offset)
+            yield pmid, reader.read(length)
+
+    def compact(self) -> None:
+        """
+        Rewrites the shards without replaced and deleted documents.
+        """
+        self.flush()
+        for shard in range(self.shards):
+            path = self._shard_path(shard)
+            if not os.path.exists(path):
+                continue
+            rows = self.connection.execute("SELECT pmid, offset, length FROM documents WHERE shard = ? ORDER BY offset",
+                                           (shard,)).fetchall()
+            updates = []
+            reader = self._reader(shard)
+            with open(f"{path}.tmp", "wb") as output:
+                for pmid, offset, length in rows:
+                    reader.seek(offset)
+                    updates.append((output.tell(), pmid))
+                    output.write(reader.read(length))
+            for handles in (self._readers, self._writers):
+                if shard in handles:
+                    handles.pop(shard).close()
+            os.replace(f"{path}.tmp", path)
+            self.connection.executemany("UPDATE documents SET offset = ? WHERE pmid = ?", updates)
+            self.connection.commit()
+        logging.info(f"Compacted {len(self)} documents in {self.directory}.")
+
+    def close(self) -> None:
+        """
+        Flushes and closes the store.
+        """
+        if not self.readonly:
+            self.flush()
+        for handles in (self._readers, self._writers):
+            for handle in handles.values():
+                handle.close()
+            handles.clear()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def pack_directory(directory: str, store_directory: str, shards: int = 64) -> None:
+    """
+    Packs a directory of {pmid}.xml files into a sharded store.
+
+    Parameters
+    ----------
+    directory: str
+        Path to the directory with the per-PMID xml files.
+    store_directory: str
+        Path to the store directory.
+    shards: int
+        Number of shard files of a new store.
+    """
+    with ShardedStore(store_directory, shards) as store:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                pmid, extension = os.path.splitext(entry.name)
+                if extension == ".xml" and pmid.isdigit():
+                    with open(entry.path, "rb") as file:
+                        store.put(pmid, file.read())
+
+
+def unpack_store(store_directory: str, directory: str) -> None:
+    """
+    Writes every document of a sharded store to {directory}/{pmid}.xml.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with ShardedStore(store_directory, readonly=True) as store:
+        for pmid, document in store.items():
+            with open(os.path.join(directory, f"{pmid}.xml"), "wb") as file:
+                file.write(document)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--input", type=str,
+                        help="Path to input directory of {pmid}.xml files or sharded store")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Path to output sharded store or directory")
+    parser.add_argument("--shards", type=int, default=64,
+                        help="Number of shard files of a new store")
+    parser.add_argument("--compact", action="store_true",
+                        help="Compact the input store in place")
+    args = parser.parse_args()
+
+    if args.compact:
+        with ShardedStore(args.input) as store:
+            store.compact()
+    elif is_store(args.input):
+        unpack_store(args.input, args.output)
+    else:
+        pack_directory(args.input, args.output, args.shards)
@@ -1,9 +1,35 @@
+import os
+import sys
+import shutil
 import argparse
 import numpy as np
-import nltk
-from nltk.corpus import stopwords
 
-def prepare_from_npy(filepath_in: str, filepath_out: str):
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data-preprocessing'))
+from token_corpus import FIELDS, VOCAB_FILE, read_vocab
+
+# NLTK english stopword list, bundled so that no download is needed.
+STOPWORDS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'stopwords_english.txt')
+
+
+def load_stop_words(filepath: str = None) -> set:
+    '''
+    Reads the stopword list from a local file with one word per line.
+
+    Parameters
+    ----------
+    filepath: str
+        The filepath of the stopword list, defaults to the bundled NLTK english list.
+
+    Returns
+    -------
+    stop_words: set
+        Set of stopwords.
+    '''
+    with open(filepath or STOPWORDS_FILE, encoding='utf-8') as file:
+        return {line.strip() for line in file if line.strip()}
+
+
+def prepare_from_npy(filepath_in: str, filepath_out: str, stop_words: set = None):
     '''
     Removes stopwords for the tokenized npy file format, as an optional step in preprocessing.
 
@@ -13,22 +39,102 @@ def prepare_from_npy(filepath_in: str, filepath_out: str):
         The filepath of the RELISH input npy file.
     filepath_out: str
         The filepath of the RELISH output npy file.
+    stop_words: set
+        Set of stopwords, defaults to the bundled NLTK english list.
     '''
-    nltk.download('stopwords')
-    stop_words = set(stopwords.words('english'))
+    stop_words = stop_words if stop_words is not None else load_stop_words()
     doc = np.load(filepath_in, allow_pickle=True)
     for line in doc:
         line[1] = [w for w in line[1] if not w in stop_words]
         line[2] = [w for w in line[2] if not w in stop_words]
     np.save(filepath_out, doc, allow_pickle=True)
 
+
+def prepare_from_shards(directory_in: str, directory_out: str, stop_words: set = None):
+    '''
+    Removes stopwords from a directory of tokenized npy shards (as written by the streaming
+    mode of preprocessing.py) one shard at a time, so only a single shard is kept in memory.
+
+    Parameters
+    ----------
+    directory_in: str
+        The directory with the input shard-*.npy files.
+    directory_out: str
+        The directory for the output shards, which keep the names of the input shards.
+    stop_words: set
+        Set of stopwords, defaults to the bundled NLTK english list.
+    '''
+    stop_words = stop_words if stop_words is not None else load_stop_words()
+    os.makedirs(directory_out, exist_ok=True)
+    for name in sorted(os.listdir(directory_in)):
+        if name.endswith('.npy'):
+            prepare_from_npy(os.path.join(directory_in, name), os.path.join(directory_out, name), stop_words)
+
+
+def prepare_from_corpus(directory_in: str, directory_out: str, stop_words: set = None, chunk_size: int = 1 << 24):
+    '''
+    Removes stopwords from a token id corpus (see token_corpus.py). The stopwords are turned into
+    a boolean mask over the vocabulary once, the token ids are then filtered in chunks of
+    chunk_size tokens and written straight into memory-mapped output arrays.
+
+    Parameters
+    ----------
+    directory_in: str
+        The directory of the input corpus.
+    directory_out: str
+        The directory of the output corpus, which shares the vocabulary of the input corpus.
+    stop_words: set
+        Set of stopwords, defaults to the bundled NLTK english list.
+    chunk_size: int
+        Number of tokens filtered at a time.
+    '''
+    stop_words = stop_words if stop_words is not None else load_stop_words()
+    keep = np.array([token not in stop_words for token in read_vocab(directory_in)], dtype=bool)
+    os.makedirs(directory_out, exist_ok=True)
+    for name in (VOCAB_FILE, 'pmids.npy', 'pmid_index.npy', 'pmid_rows.npy'):
+        shutil.copyfile(os.path.join(directory_in, name), os.path.join(directory_out, name))
+
+    for field in FIELDS:
+        ids = np.load(os.path.join(directory_in, f'{field}_ids.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(directory_in, f'{field}_offsets.npy'))
+        chunks = [(start, min(start + chunk_size, len(ids))) for start in range(0, len(ids), chunk_size)]
+        total = sum(int(keep[ids[start:end]].sum()) for start, end in chunks)
+
+        ids_out = np.lib.format.open_memmap(os.path.join(directory_out, f'{field}_ids.npy'),
+                                            mode='w+', dtype=np.int32, shape=(total,))
+        offsets_out = np.zeros_like(offsets)
+        written = 0
+        for start, end in chunks:
+            chunk = np.asarray(ids[start:end])
+            kept = keep[chunk]
+            ids_out[written:written + kept.sum()] = chunk[kept]
+            # Number of kept tokens in front of every position of the chunk.
+            kept_before = np.concatenate(([0], np.cumsum(kept)))
+            first, last = np.searchsorted(offsets, start, 'left'), np.searchsorted(offsets, end, 'right')
+            offsets_out[first:last] = written + kept_before[offsets[first:last] - start]
+            written += int(kept.sum())
+        ids_out.flush()
+        del ids_out
+        np.save(os.path.join(directory_out, f'{field}_offsets.npy'), offsets_out)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-i", "--input", type=str,
-                       help="Path to input tokenized NPY file")
+                       help="Path to input tokenized NPY file, directory of NPY shards or token id corpus directory")
     parser.add_argument("-o", "--output", type=str,
-                       help="Path to output tokenized NPY file")
+                       help="Path to output tokenized NPY file or directory")
+    parser.add_argument("-s", "--stopwords", type=str, default=None,
+                       help="Path to a stopword list with one word per line (defaults to the bundled NLTK list)")
+    parser.add_argument("--chunk_size", type=int, default=1 << 24,
+                       help="Number of tokens filtered at a time for token id corpora")
     args = parser.parse_args()
 
-    prepare_from_npy(args.input, args.output)
+    stop_words = load_stop_words(args.stopwords)
+    if os.path.exists(os.path.join(args.input, VOCAB_FILE)):
+        prepare_from_corpus(args.input, args.output, stop_words, args.chunk_size)
+    elif os.path.isdir(args.input):
+        prepare_from_shards(args.input, args.output, stop_words)
+    else:
+        prepare_from_npy(args.input, args.output, stop_words)
@@ -3,6 +3,10 @@ import pandas as pd
 import re
 import glob
 import json
+from multiprocessing import Pool
+
+
+KEYWORDS_PATTERN = re.compile(r"(?:^[\s]*|\.|\?|: )(?: *)(?=([A-Z]+[A-Z\s&a-z]{2,69}:\s))")
 
 
 def read_files(args: argparse.Namespace) -> pd.DataFrame:
@@ -34,6 +38,88 @@ def read_files(args: argparse.Namespace) -> pd.DataFrame:
     return data
 
 
+def read_chunks(args: argparse.Namespace, chunksize: int):
+    """
+    Read the abstracts of the input files from the arguments in chunks, so
+    that the files do not need to fit into memory.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        Arguments from the argsparse package.
+    chunksize: int
+        Number of rows per chunk.
+
+    Returns
+    -------
+    chunks: generator
+        Lists of abstracts of at most chunksize rows, in the order of
+        read_files.
+    """
+    if args.input:
+        in_files = [args.input]
+    else:
+        indir = args.indir.strip("/")
+        in_files = glob.glob(f"{indir}/*.tsv")
+
+    for file in in_files:
+        for chunk in pd.read_csv(file, sep="\t", quotechar="`", usecols=["abstract"], chunksize=chunksize):
+            yield chunk["abstract"].tolist()
+
+
+def count_structure_words(abstracts) -> dict:
+    """
+    Counts in how many of the given abstracts every structure word appears.
+
+    Parameters
+    ----------
+    abstracts: iterable
+        Abstracts to match the regular expression against.
+
+    Returns
+    -------
+    structure_words_dict: dict
+        Dictionary where the keys are the matched structure words, in order of
+        first appearance, and the values are the number of abstracts in which
+        the structure word is found.
+    """
+    structure_words_dict = {}
+
+    for abstract in abstracts:
+        # dict.fromkeys keeps the order of the matches, unlike a set, so that
+        # words with the same count are listed in the same order by every run.
+        structure_words = dict.fromkeys(KEYWORDS_PATTERN.findall(abstract))
+        for word in structure_words:
+            structure_words_dict[word] = structure_words_dict.get(word, 0) + 1
+
+    return structure_words_dict
+
+
+def merge_dictionaries(partial_dicts) -> dict:
+    """
+    Merges the counts of consecutive chunks of abstracts. Merging the counts
+    of all chunks in their order gives the same dictionary, including the
+    order of its keys, as counting all abstracts at once.
+
+    Parameters
+    ----------
+    partial_dicts: iterable
+        Dictionaries returned by count_structure_words, in chunk order.
+
+    Returns
+    -------
+    structure_words_dict: dict
+        Merged dictionary of counts.
+    """
+    structure_words_dict = {}
+
+    for partial_dict in partial_dicts:
+        for word, count in partial_dict.items():
+            structure_words_dict[word] = structure_words_dict.get(word, 0) + count
+
+    return structure_words_dict
+
+
 def create_dictionary(data: pd.DataFrame) -> dict:
     """
     Given the input dataframe containing an abstrat column, matches de regular
@@ -51,15 +137,43 @@ def create_dictionary(data: pd.DataFrame) -> dict:
         are the number of articles in which the structure word is found.
 
     """
-    structure_words_dict = {}
-    keywords_pattern = r"(?:^[\s]*|\.|\?|: )(?: *)(?=([A-Z]+[A-Z\s&a-z]{2,69}:\s))"
+    return count_structure_words(data["abstract"])
 
-    for abstract in data["abstract"]:
-        structure_words = set(re.findall(keywords_pattern, abstract))
-        for word in structure_words:
-            structure_words_dict[word] = structure_words_dict.get(word, 0) + 1
 
-    return structure_words_dict
+def create_dictionary_chunked(chunks, processes: int = 1) -> tuple:
+    """
+    Counts the structure words of chunks of abstracts in a process pool and
+    merges the partial counts.
+
+    Parameters
+    ----------
+    chunks: iterable
+        Lists of abstracts, i.e. from read_chunks.
+    processes: int
+        Number of worker processes.
+
+    Returns
+    -------
+    structure_words_dict: dict
+        Same dictionary as create_dictionary over all abstracts.
+    num_articles: int
+        Number of abstracts.
+    """
+    num_articles = 0
+
+    def counted(chunks):
+        nonlocal num_articles
+        for chunk in chunks:
+            num_articles += len(chunk)
+            yield chunk
+
+    if processes > 1:
+        with Pool(processes) as pool:
+            structure_words_dict = merge_dictionaries(pool.imap(count_structure_words, counted(chunks)))
+    else:
+        structure_words_dict = merge_dictionaries(map(count_structure_words, counted(chunks)))
+
+    return structure_words_dict, num_articles
 
 
 def sort_dictionary(structure_words_dict: dict) -> dict:
@@ -200,6 +314,40 @@ def export_to_list(out_file: str, word_list: list) -> None:
         json.dump(word_list, file, indent=0)
 
 
+def select_structure_words(SW_dict: dict, num_articles: int, ratio_threshold: float = 0,
+                           occurrences_threshold: int = 0) -> list:
+    """
+    Sorts the dictionary of structure word counts and prunes it according to
+    the input thresholds.
+
+    Parameters
+    ----------
+    SW_dict: dict
+        Dictionary where the keys are the matched structure words and the values
+        are the number of articles in which the structure word is found.
+    num_articles: int
+        Number of articles in the dataset.
+    ratio_threshold: float
+        Minimum relative frequency of appearance of the structure word to be
+        kept in the list of dictionaries.
+    occurrences_threshold: float
+        Minimum total occurrences of the structure word to be kept in the list
+        of dictionaries.
+
+    Returns
+    -------
+    SW_json_pruned: list[dict]
+        Pruned list of dictionaries containing information of all the matched
+        structure words that satisfy the imposed thresholds.
+    """
+    SW_dict = sort_dictionary(SW_dict)
+    SW_json = convert_to_json(SW_dict, num_articles)
+    SW_json_pruned = prune_structure_words(
+        SW_json, ratio_threshold, occurrences_threshold)
+
+    return SW_json_pruned
+
+
 def structure_words_pipeline(data: pd.DataFrame, ratio_threshold: float = 0, occurrences_threshold: int = 0) -> list:
     """
     Pipeline of all the required functions. From the data, it creates the
@@ -224,12 +372,8 @@ def structure_words_pipeline(data: pd.DataFrame, ratio_threshold: float = 0, occ
         structure words that satisfy the imposed thresholds.
     """
     SW_dict = create_dictionary(data)
-    SW_dict = sort_dictionary(SW_dict)
-    SW_json = convert_to_json(SW_dict, len(data))
-    SW_json_pruned = prune_structure_words(
-        SW_json, ratio_threshold, occurrences_threshold)
 
-    return SW_json_pruned
+    return select_structure_words(SW_dict, len(data), ratio_threshold, occurrences_threshold)
 
 
 if __name__ == "__main__":
@@ -246,13 +390,23 @@ if __name__ == "__main__":
                         help="Minimum relative frequency of appearance of the structure word to be considered")
     parser.add_argument("--occurrences_threshold", type=int, default=0,
                         help="Minimum total occurrences of the structure word to be considered")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Read the input in chunks of this many rows instead of all at once")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes counting the chunks")
     args = parser.parse_args()
     out_file = args.output
 
-    data = read_files(args)
+    if args.chunksize or args.processes > 1:
+        SW_dict, num_articles = create_dictionary_chunked(
+            read_chunks(args, args.chunksize or 10000), args.processes)
+        SW_json_pruned = select_structure_words(
+            SW_dict, num_articles, ratio_threshold=args.ratio_threshold, occurrences_threshold=args.occurrences_threshold)
+    else:
+        data = read_files(args)
 
-    SW_json_pruned = structure_words_pipeline(
-        data, ratio_threshold=args.ratio_threshold, occurrences_threshold=args.occurrences_threshold)
+        SW_json_pruned = structure_words_pipeline(
+            data, ratio_threshold=args.ratio_threshold, occurrences_threshold=args.occurrences_threshold)
 
     # By default, both a .json file and a .txt file are created given the output filename.
     export_to_json(out_file, SW_json_pruned)
@@ -4,12 +4,28 @@ import re
 import glob
 import logging
 
+from io import BytesIO
+from itertools import islice
 from typing import Union, List
+from multiprocessing import Pool
+from xml.etree import ElementTree as ET
 
 import argparse
 import json
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "pmid-store"))
+from sharded_store import ShardedStore, is_store
+from pmid_registry import PMIDRegistry, STRUCTURE_WORDS, CLEANED
+
+KEYWORDS_PATTERN = re.compile(r"(?:^[\s]*|\.|\?|: )(?: *)(?=([A-Z]+[A-Z\s&a-z]{2,69}:\s))")
+
+# XML files larger than this are streamed element by element instead of being parsed at once.
+STREAM_SIZE = 1 << 24
+XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>\n"
+# Number of store documents handed to the worker processes at once.
+STORE_BATCH_SIZE = 4096
+
 
 def read_files(args: argparse.Namespace) -> pd.DataFrame:
     """
@@ -40,6 +56,34 @@ def read_files(args: argparse.Namespace) -> pd.DataFrame:
     return data
 
 
+def read_chunks(args: argparse.Namespace, chunksize: int):
+    """
+    Read the input files from the arguments in chunks of rows, so that the
+    files do not need to fit into memory.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        Arguments from the argsparse package.
+    chunksize: int
+        Number of rows per chunk.
+
+    Returns
+    -------
+    chunks: generator
+        Dataframes of at most chunksize rows with the columns of the input
+        files, in the order of read_files.
+    """
+    if args.input:
+        in_files = [args.input]
+    else:
+        indir = args.indir.strip("/")
+        in_files = glob.glob(f"{indir}/*.tsv")
+
+    for file in in_files:
+        yield from pd.read_csv(file, sep="\t", quotechar="`", chunksize=chunksize)
+
+
 def read_json(input_list: str) -> list:
     """
     Read a .json file containing information about the structure words. The
@@ -115,6 +159,124 @@ def remove_span_matches(abstract: str, span_range: list) -> str:
     return "".join(output)
 
 
+def literal_pattern(words: list) -> str:
+    """
+    Builds a regular expression matching any of the given words, with the
+    words merged into a prefix tree so that the cost of a match depends on the
+    length of the words rather than on their number. At every position the
+    longest matching word is chosen.
+
+    Parameters
+    ----------
+    words: list
+        Non-empty literal words.
+
+    Returns
+    -------
+    str:
+        Regular expression pattern.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        # Trying the longer words first and falling back to the word ending
+        # here keeps the longest match.
+        return pattern + "?" if "" in node else pattern
+
+    return build(trie)
+
+
+class StructureWordRemover:
+    """
+    Removes a list of structure words from strings, dataframes and XML text
+    nodes. The list is compiled once: words matching the structure word
+    regular expression are removed where the expression matches them, all
+    other words are removed wherever they occur with a single pattern.
+
+    Parameters
+    ----------
+    structure_words_list: list
+        List of structure words.
+    """
+
+    def __init__(self, structure_words_list: list):
+        # Separate the structure words list into those that match the regular
+        # expression and those that do not. This is done in order to allow the user
+        # to input their personal structure word list that may not necessarilly
+        # match the pattern.
+        self.regex_structure_words = set()
+        non_regex_structure_words = []
+        for word in structure_words_list:
+            if KEYWORDS_PATTERN.match(word):
+                self.regex_structure_words.add(word)
+            elif word:
+                non_regex_structure_words.append(word)
+
+        self.literal_pattern = None
+        if non_regex_structure_words:
+            self.literal_pattern = re.compile(literal_pattern(non_regex_structure_words))
+
+    def remove_string(self, text: str) -> str:
+        """
+        Removes the structure words from a string.
+        """
+        span_ranges = [match.span(1) for match in KEYWORDS_PATTERN.finditer(text)
+                       if match.group(1) in self.regex_structure_words]
+
+        if span_ranges:
+            text = remove_span_matches(text, span_ranges)
+        if self.literal_pattern is not None:
+            text = self.literal_pattern.sub("", text)
+
+        return text
+
+    def remove_dataframe(self, data: pd.DataFrame, column: str = "abstract") -> pd.DataFrame:
+        """
+        Removes the structure words from a column of a dataframe in place.
+        """
+        data[column] = [self.remove_string(text) if isinstance(text, str) else text
+                        for text in data[column]]
+
+        return data
+
+    def remove_xml(self, xml_tree):
+        """
+        Removes the structure words from all <text> nodes of an XML tree or
+        element in place.
+        """
+        for text_tag in xml_tree.iter("text"):
+            if text_tag.text:
+                text_tag.text = self.remove_string(text_tag.text)
+
+        return xml_tree
+
+    def remove(self, data: Union[str, pd.DataFrame]) -> Union[str, pd.DataFrame]:
+        """
+        Removes the structure words from either a dataframe with the abstract
+        column in the data, or a string.
+        """
+        if isinstance(data, pd.DataFrame):
+            return self.remove_dataframe(data)
+        elif isinstance(data, str):
+            return self.remove_string(data)
+
+        logging.error(
+            "The input parameter should be either a dataframe or a string.")
+
+        return data
+
+
 def structure_words_remover(data: Union[str, pd.DataFrame], 
                             structure_words_list: list) -> pd.DataFrame:
     """
@@ -126,8 +288,8 @@ def structure_words_remover(data: Union[str, pd.DataFrame],
     data: pd.DataFrame or str
         Dataframe containing an abstract column or string to remove structure
         words from.
-    structure_words_list: list
-        List of structure words.
+    structure_words_list: list or StructureWordRemover
+        List of structure words, or a remover compiled from the list.
 
     Returns
     -------
@@ -135,55 +297,10 @@ def structure_words_remover(data: Union[str, pd.DataFrame],
         Dataframe with the structure words removed from its abstract column or
         a string.
     """
-    keywords_pattern = r"(?:^[\s]*|\.|\?|: )(?: *)(?=([A-Z]+[A-Z\s&a-z]{2,69}:\s))"
-
-    # Separate the structure words list into those that match the regular
-    # expression and those that do not. This is done in order to allow the user
-    # to input their personal structure word list that may not necessarilly
-    # match the pattern.
-    regex_structure_words = []
-    non_regex_strcuture_words = []
-    for word in structure_words_list:
-        if re.match(keywords_pattern, word):
-            regex_structure_words.append(word)
-        else:
-            non_regex_strcuture_words.append(word)
-
-    if isinstance(data, pd.DataFrame):
-        for i, row in data.iterrows():
-            abstract = row["abstract"]
-            # Only write in the dataframe if the abstract is modified.
-            save_abstract = False
-
-            # Regular expression structure words
-            span_ranges = [match.span(1) for match in re.finditer(
-                keywords_pattern, abstract) if match.group(1) in regex_structure_words]
-
-            if span_ranges:
-                abstract = remove_span_matches(abstract, span_ranges)
-                save_abstract = True
-
-            # Non regular expression structure words
-            for word in non_regex_strcuture_words:
-                if not save_abstract and word in abstract:
-                    save_abstract = True
-                abstract = abstract.replace(word, "")
-
-            if save_abstract:
-                data.at[i, "abstract"] = abstract
-    elif isinstance(data, str):
-        span_ranges = [match.span(1) for match in re.finditer(
-            keywords_pattern, data) if match.group(1) in regex_structure_words]
+    if not isinstance(structure_words_list, StructureWordRemover):
+        structure_words_list = StructureWordRemover(structure_words_list)
 
-        if span_ranges:
-            data = remove_span_matches(data, span_ranges)
-        for word in non_regex_strcuture_words:
-            data = data.replace(word, "")
-    else:
-        logging.error(
-            "The input parameter should be either a dataframe or a string.")
-
-    return data
+    return structure_words_list.remove(data)
 
 
 def save_output(data: pd.DataFrame, output_file: str) -> None:
@@ -203,6 +320,45 @@ def save_output(data: pd.DataFrame, output_file: str) -> None:
     data.to_csv(output_file, sep="\t", quotechar="`", index=False)
 
 
+def pipeline_tsv_chunked(chunks, output_file: str, structure_words_list) -> list:
+    """
+    Removes the structure words from chunks of a dataset and appends every
+    cleaned chunk to the output file, writing the header with the first chunk
+    only.
+
+    Parameters
+    ----------
+    chunks: iterable
+        Dataframes containing an abstract column, i.e. from read_chunks.
+    output_file: str
+        Path to the output .tsv file where the articles are saved without
+        structure words.
+    structure_words_list: list
+        List of structure words.
+
+    Returns
+    -------
+    pmids: list
+        PMIDs of all processed rows.
+    """
+    if not output_file.endswith(".tsv"):
+        output_file += ".tsv"
+    remover = StructureWordRemover(structure_words_list)
+
+    pmids = []
+    header = True
+    with open(output_file, "w", newline="") as file:
+        for chunk in chunks:
+            chunk = remover.remove_dataframe(chunk)
+            chunk.to_csv(file, sep="\t", quotechar="`", index=False, header=header)
+            header = False
+            if "PMID" in chunk.columns:
+                pmids.extend(chunk["PMID"].tolist())
+            logging.info(f"{len(pmids)} rows written to {output_file}.")
+
+    return pmids
+
+
 def load_input_xml(args: argparse.ArgumentParser) -> Union[List[str], List[str]]:
     """
     Process the arguments passed to the script to obtain a list of
@@ -215,12 +371,18 @@ def load_input_xml(args: argparse.ArgumentParser) -> Union[List[str], List[str]]
 
     Returns
     -------
-    files_in: list[str]
-        List of input files.
-    files_out: list[str]
-        List of output files.
+    files_in: list[str] or ShardedStore
+        List of input files, or the input store if the input directory is a
+        sharded store (see code/pmid-store).
+    files_out: list[str] or ShardedStore
+        List of output files, or the output store.
     """
-    if args.indir:      # If the user inputs a directory
+    if args.indir and is_store(args.indir):     # If the user inputs a sharded store
+        indir = args.indir.rstrip("/")
+        outdir = args.output if args.output != "data_pruned.tsv" else indir + "_no_structure_words"
+        logging.info(f"Documents from {indir} will be trasnlated into {outdir}")
+        return ShardedStore(indir, readonly=True), ShardedStore(outdir)
+    elif args.indir:      # If the user inputs a directory
         if args.indir.endswith(".xml"):
             logging.error(
                 f"Your input is not a directory, please use --input instead.", exc_info=False)
@@ -252,32 +414,204 @@ def load_input_xml(args: argparse.ArgumentParser) -> Union[List[str], List[str]]
     return files_in, files_out
 
 
-def pipeline_xml(files_in: List[str], files_out: List[str], structure_words_list):
+def xml_pmids(files_in: Union[List[str], ShardedStore]) -> list:
     """
-    Pipeline to remove a list of structure words from the input XML files. The
-    output is always another XML file for each input. 
+    Returns the PMIDs of the input XML files, named {pmid}.xml, or of the
+    input store.
+    """
+    if isinstance(files_in, ShardedStore):
+        return files_in.keys()
+    pmids = [os.path.splitext(os.path.basename(file))[0] for file in files_in]
+    return [pmid for pmid in pmids if pmid.isdigit()]
+
+
+_remover = None
+
+
+def _init_remover(remover: StructureWordRemover) -> None:
+    """
+    Pool initializer shipping the compiled remover once to every worker.
+    """
+    global _remover
+    _remover = remover
+
+
+def remove_xml_document(item: tuple) -> tuple:
+    """
+    Removes the structure words from an XML document of a store.
+
+    Parameters
+    ----------
+    item: tuple
+        (pmid, content of the XML file)
+
+    Returns
+    -------
+    tuple:
+        (pmid, document as written by ElementTree.write)
+    """
+    pmid, document = item
+    xml_tree = ET.ElementTree(ET.fromstring(document))
+    _remover.remove_xml(xml_tree)
+
+    output = BytesIO()
+    xml_tree.write(output, encoding="utf-8", xml_declaration=True)
+    return pmid, output.getvalue()
+
+
+def _root_tags(root: ET.Element) -> tuple:
+    """
+    Returns the serialized start tag, including its text, and end tag of the
+    root element, exactly as ElementTree writes them around the children.
+    """
+    marker = "structure-words-marker"
+    shell = ET.Element(root.tag, root.attrib)
+    shell.text = root.text
+    ET.SubElement(shell, marker)
+    start, end = ET.tostring(shell, encoding="unicode").split(f"<{marker} />")
+    return start, end
+
+
+def stream_xml_file(file_in: str, file_out: str) -> bool:
+    """
+    Removes the structure words from a large XML file, i.e. a BioC collection
+    with many documents, keeping only one child of the root element in memory.
+    The output is identical to parsing the whole file and writing it with
+    ElementTree.write.
+
+    Files declaring XML namespaces are not streamed, since ElementTree declares
+    the prefixes on the root when writing a whole tree but on every child when
+    serializing the children one by one.
 
     Parameters
     ----------
-    files_in : list[str]
-        List of input files.
-    files_out : list[str]
-        List of output files.
+    file_in: str
+        Path to the input XML file.
+    file_out: str
+        Path to the output XML file.
+
+    Returns
+    -------
+    bool:
+        False if a namespace declaration was found, the output is incomplete then.
     """
-    from xml.etree import ElementTree as ET
+    depth = 0
+    root = None
+    pending = None
+    end_tag = None
+    with open(file_out, "w", encoding="utf-8") as output:
+        output.write(XML_DECLARATION)
+
+        def write(element):
+            _remover.remove_xml(element)
+            output.write(ET.tostring(element, encoding="unicode"))
+            root.remove(element)
+
+        for event, element in ET.iterparse(file_in, events=("start", "end", "start-ns")):
+            if event == "start-ns":
+                return False
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = element
+                elif depth == 2:
+                    # The previous child is complete, including its tail, once
+                    # the next one starts.
+                    if pending is not None:
+                        write(pending)
+                        pending = None
+                    elif end_tag is None:
+                        start_tag, end_tag = _root_tags(root)
+                        output.write(start_tag)
+            else:
+                depth -= 1
+                if depth == 1:
+                    pending = element
+                elif depth == 0:
+                    if end_tag is None:
+                        # Without children the root is written on its own.
+                        output.write(ET.tostring(root, encoding="unicode"))
+                    else:
+                        write(pending)
+                        output.write(end_tag)
+    return True
+
+
+def remove_xml_file(task: tuple) -> str:
+    """
+    Removes the structure words from an XML file, streaming it if it is larger
+    than the given size.
 
-    for i, file, in enumerate(files_in):
-        logging.info(f"File {file} open.")
+    Parameters
+    ----------
+    task: tuple
+        (input file, output file, stream size)
 
-        xml_tree = ET.parse(file)
-        xml_root = xml_tree.getroot()
+    Returns
+    -------
+    str:
+        Path to the input file.
+    """
+    file_in, file_out, stream_size = task
+    # Files with namespaces are parsed as a whole after all, see stream_xml_file.
+    if stream_size is not None and os.path.getsize(file_in) > stream_size and stream_xml_file(file_in, file_out):
+        return file_in
+
+    xml_tree = ET.parse(file_in)
+    _remover.remove_xml(xml_tree)
 
-        for text_tag in xml_root.iter("text"):
-            text_tag.text = structure_words_remover(
-                text_tag.text, structure_words_list)
+    with open(file_out, "wb") as file:
+        xml_tree.write(file, encoding="utf-8", xml_declaration=True)
+    return file_in
 
-        with open(files_out[i], "wb") as file:
-            xml_tree.write(file, encoding="utf-8", xml_declaration=True)
+
+def pipeline_xml(files_in: List[str], files_out: List[str], structure_words_list, processes: int = 1,
+                 stream_size: int = STREAM_SIZE):
+    """
+    Pipeline to remove a list of structure words from the input XML files. The
+    output is always another XML file for each input. 
+
+    Parameters
+    ----------
+    files_in : list[str] or ShardedStore
+        List of input files, or a store whose documents are read in storage order.
+    files_out : list[str] or ShardedStore
+        List of output files, or a store the documents are appended to.
+    structure_words_list: list
+        List of structure words.
+    processes: int
+        Number of worker processes the files or documents are distributed across.
+    stream_size: int
+        Files larger than this number of bytes are streamed element by element,
+        None to always parse the whole file.
+    """
+    remover = StructureWordRemover(structure_words_list)
+    pool = Pool(processes, _init_remover, (remover,)) if processes > 1 else None
+    if pool is None:
+        _init_remover(remover)
+    imap = (lambda function, items: pool.imap(function, items, chunksize=64)) if pool is not None else map
+
+    try:
+        if isinstance(files_in, ShardedStore):
+            with files_in, files_out:
+                # The store is read in batches by this thread, as its index
+                # cannot be used from the thread feeding the pool.
+                items = files_in.items()
+                batch = list(islice(items, STORE_BATCH_SIZE))
+                while batch:
+                    for pmid, document in imap(remove_xml_document, batch):
+                        files_out.put(pmid, document)
+                    batch = list(islice(items, STORE_BATCH_SIZE))
+            return
+
+        tasks = [(file_in, file_out, stream_size) for file_in, file_out in zip(files_in, files_out)]
+        for file in (pool.imap_unordered(remove_xml_file, tasks, chunksize=64) if pool is not None
+                     else map(remove_xml_file, tasks)):
+            logging.info(f"File {file} done.")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 if __name__ == "__main__":
@@ -294,15 +628,29 @@ if __name__ == "__main__":
                         help="Path to output text file/dir")
     parser.add_argument("--xml", type=int, default=0,
                         help="Indicate if the input is an XML file.")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Process the TSV input in chunks of this many rows instead of all at once")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes the XML files are distributed across")
+    parser.add_argument("--registry", type=str, default=None,
+                        help="Path to a PMID registry the cleaned PMIDs are recorded in")
     args = parser.parse_args()
     out_file = args.output
     structure_words_list = read_list(args.list)
 
     if args.xml:
         files_in, files_out = load_input_xml(args)
-        pipeline_xml(files_in, files_out, structure_words_list)
+        pmids = xml_pmids(files_in) if args.registry else []
+        pipeline_xml(files_in, files_out, structure_words_list, args.processes)
+    elif args.chunksize:
+        pmids = pipeline_tsv_chunked(read_chunks(args, args.chunksize), out_file, structure_words_list)
     else:
         data = read_files(args)
 
         data = structure_words_remover(data, structure_words_list)
         save_output(data, out_file)
+        pmids = data["PMID"]
+
+    if args.registry:
+        with PMIDRegistry(args.registry) as registry:
+            registry.update(STRUCTURE_WORDS, pmids, CLEANED)
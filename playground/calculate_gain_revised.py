@@ -7,28 +7,35 @@ import argparse
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 sys.path.append(parentdir)
+sys.path.append(os.path.join(parentdir, 'code', 'data-preprocessing'))
 
 import math
 import pandas as pd
 import numpy as np
 from typing import Any, List, Tuple
 from numpy import ndarray
+from ground_truth import load_ground_truth, attach_relevance
 # import hyperparameter_optimization as hp
 
 
-def load_cosine_sim_matrix(cosine_similarity_matrix: str) -> pd.DataFrame:
+def load_cosine_sim_matrix(cosine_similarity_matrix: str, ground_truth: str = None) -> pd.DataFrame:
     """
     Loads and return a pandas dataframe object of the cosine similarity matrix.
     Parameters
     ----------
     cosine_similarity_matrix : str
         Filepath for the cosine similarity matrix of existing pairs in the TSV format.
+    ground_truth : str
+        Optional filepath for the RELISH/TREC ground truth (TSV or binary .qrels store). If given, the
+        Relevance column is taken from the memory-mapped ground truth instead of the input file.
     Returns
     -------
     sim_matrix : pd.Dataframe
         Cosine similarity matrix.
     """
     sim_matrix = pd.read_csv(cosine_similarity_matrix, sep='\t')
+    if ground_truth:
+        sim_matrix = attach_relevance(sim_matrix, load_ground_truth(ground_truth))
     return sim_matrix
 
 
@@ -245,12 +252,14 @@ if __name__ == "__main__":
                         help="Path for TREC/RELISH 4 column TSV file (with relevance and cosine similarity scores).")
     parser.add_argument('-o', '--output', type=str, help="Path for generated nDCG@n matrix TSV file.")
     parser.add_argument('-n', '--number', type=int, help="Number for the hyperparameter combination.")
+    parser.add_argument('-g', '--ground_truth', type=str, default=None,
+                        help="Optional path for the ground truth TSV or .qrels file to take the relevance scores from.")
     args = parser.parse_args()
 
     if not os.path.exists("./data/output/gain_matrices"):
         os.makedirs("./data/output/gain_matrices")
 
-    similarity_matrix = load_cosine_sim_matrix(args.input)
+    similarity_matrix = load_cosine_sim_matrix(args.input, args.ground_truth)
     get_dcg_matrix(similarity_matrix, f"./data/output/gain_matrices/dcg_{args.number}.tsv")
     get_identity_dcg_matrix(similarity_matrix, f"./data/output/gain_matrices/idcg_{args.number}.tsv")
     pmids, ndcg_matrix = fill_ndcg_scores(f"./data/output/gain_matrices/dcg_{args.number}.tsv", f"./data/output/gain_matrices/idcg_{args.number}.tsv")
@@ -1,10 +1,15 @@
+import os
+import sys
 import argparse
 import pandas as pd
 import numpy as np
 from typing import List, Tuple
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'code', 'data-preprocessing'))
+from ground_truth import load_ground_truth, attach_relevance
 
-def read_file(tsv_file: str) -> Tuple[List, pd.DataFrame]:
+
+def read_file(tsv_file: str, ground_truth: str = None) -> Tuple[List, pd.DataFrame]:
     """
     Reads the input 4-column cosine similarity existing pairs TSV file in a pandas dataframe, generates all the unique PMIDs
     and returns the dataframe.
@@ -12,6 +17,9 @@ def read_file(tsv_file: str) -> Tuple[List, pd.DataFrame]:
     ----------
     tsv_file : str
         File path to the 4-column cosine similarity existing pairs TSV file.
+    ground_truth : str
+        Optional file path to the ground truth (TSV or binary .qrels store). If given, the Relevance column is taken
+        from the memory-mapped ground truth instead of the input file.
     Returns
     -------
     ref_pmids : list
@@ -21,6 +29,8 @@ def read_file(tsv_file: str) -> Tuple[List, pd.DataFrame]:
     """
     colnames = ["PMID1", "PMID2", "Relevance", "Cosine Similarity"]
     data = pd.read_csv(tsv_file, sep='\t', header=0, names=colnames)
+    if ground_truth:
+        data = attach_relevance(data, load_ground_truth(ground_truth))
     ref_pmids = data["PMID1"].unique()
     return ref_pmids, data
 
@@ -120,9 +130,11 @@ if __name__ == "__main__":
                         , required=True)
     parser.add_argument("-o", "--output_path", help="File path to save the precision matrix",
                         required=True)
+    parser.add_argument("-g", "--ground_truth", help="Optional file path to the ground truth TSV or .qrels file to take the relevance scores from",
+                        default=None)
 
     args = parser.parse_args()
 
-    ref_pmids, data = read_file(args.cosine_file_path)
+    ref_pmids, data = read_file(args.cosine_file_path, args.ground_truth)
     matrix = generate_matrix(ref_pmids, data)
     write_to_tsv(ref_pmids, matrix, args.output_path)
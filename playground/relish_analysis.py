@@ -1,8 +1,13 @@
+import os
+import sys
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'code', 'data-preprocessing'))
+from ground_truth import load_ground_truth
+
 file_path = 'playground/RELISH.tsv'
 column_names = ['PMID1', 'PMID2', 'Relevance']
-df = pd.read_csv(file_path, sep='\t', names=column_names)
+df = load_ground_truth(file_path).to_dataframe(column_names)
 
 #  Analyzing number of unique reference PMIDs
 print(len(df['PMID1'].unique()))